@@ -0,0 +1,144 @@
+"""
+MessageService on asyncio for the host side gateway, one event loop serves many links. On CPython the entry point
+calls `compat.install()` before importing this module.
+"""
+
+import asyncio
+from message import Parser, Message
+
+
+class AsyncMessageService(object):
+
+    def __init__(self, reader, writer, reassembly_limit=8192, reassembly_timeout=30):
+        self.reader = reader
+        self.writer = writer
+        self.parser = Parser()
+        self.queue = asyncio.Queue()
+        self.ack_dict = {}  # message key -> [response, event]
+        self.stale_ack_count = 0
+        self.duplicate_ack_count = 0
+        self.read_error_count = 0
+        self.read_task = None
+        self.reassembly_limit = reassembly_limit  # bytes buffered for all unfinished groups, same on both ends.
+        self.reassembly_timeout = reassembly_timeout
+        self.reassembly_size = 0
+        self.reassembly_dict = {}  # group key -> [count, {index: fragment}, size, last time]
+        self.reassembly_drop_count = 0
+
+    @classmethod
+    async def open(cls, reader, writer):
+        self = cls(reader, writer)
+        self.start()
+        return self
+
+    def start(self):
+        if self.read_task is None:
+            self.read_task = asyncio.ensure_future(self.__read_worker())
+
+    async def close(self):
+        if self.read_task is not None:
+            self.read_task.cancel()
+            try:
+                await self.read_task
+            except asyncio.CancelledError:
+                pass
+            self.read_task = None
+        self.writer.close()
+
+    def put_ack(self, response):
+        entry = self.ack_dict.get(response.key)
+        if entry is None:
+            self.stale_ack_count += 1  # timed out, or never requested.
+            return False
+        if entry[0] is not None:
+            self.duplicate_ack_count += 1
+            return False
+        entry[0] = response
+        entry[1].set()
+        return True
+
+    async def __read_worker(self):
+        while True:
+            try:
+                data = await self.reader.read(1024)
+            except OSError:
+                data = b''
+            if not data:
+                break  # EOF, stream closed by peer.
+            try:
+                self.parser.parse(data)
+            except Exception:
+                self.read_error_count += 1
+                continue
+            for msg in self.parser.messages:
+                if msg.fragment:
+                    msg = self.__reassemble(msg)
+                    if msg is None:
+                        continue
+                if msg.ack:
+                    self.put_ack(msg)
+                else:
+                    self.queue.put_nowait(msg)
+        self.queue.put_nowait(None)  # wake up receivers.
+
+    def __reassemble(self, fragment):
+        """store and ack `fragment` like MessageService does, the joined message once the group is complete."""
+        now = asyncio.get_event_loop().time()
+        for group in [one for one, entry in self.reassembly_dict.items() if now - entry[3] > self.reassembly_timeout]:
+            self.reassembly_size -= self.reassembly_dict.pop(group)[2]
+            self.reassembly_drop_count += 1
+        ack = Message(ack=True, serial_number=fragment.serial_number, channel=fragment.channel)
+        group, index, count = fragment.fragment
+        group = (fragment.channel << 16) | group
+        body = fragment.raw_body
+        group_entry = self.reassembly_dict.get(group)
+        if group_entry is not None and index in group_entry[1]:
+            self.writer.write(ack.dump())  # retransmitted, our ack was lost.
+            return
+        if self.reassembly_size + len(body) > self.reassembly_limit:
+            self.reassembly_drop_count += 1  # not acked, the peer sends it again.
+            return
+        if group_entry is None:
+            group_entry = self.reassembly_dict[group] = [count, {}, 0, now]
+        group_entry[1][index] = fragment
+        group_entry[2] += len(body)
+        group_entry[3] = now
+        self.reassembly_size += len(body)
+        self.writer.write(ack.dump())
+        if len(group_entry[1]) < group_entry[0]:
+            return
+        del self.reassembly_dict[group]
+        self.reassembly_size -= group_entry[2]
+        return Message.join([group_entry[1][one] for one in range(group_entry[0])])
+
+    async def send(self, msg, timeout=-1):
+        entry = None
+        if timeout != 0:
+            entry = self.ack_dict[msg.key] = [None, asyncio.Event()]
+        self.writer.write(msg.dump())
+        await self.writer.drain()
+        if entry is None:
+            return
+        try:
+            await asyncio.wait_for(entry[1].wait(), timeout if timeout > 0 else None)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if self.ack_dict.get(msg.key) is entry:
+                del self.ack_dict[msg.key]
+        return entry[0]
+
+    async def recv(self):
+        msg = await self.queue.get()
+        if msg is None:
+            self.queue.put_nowait(None)  # stay closed for other receivers.
+        return msg
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self.recv()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
@@ -0,0 +1,557 @@
+"""
+Message stack benchmarks: Message.dump/load, Parser.parse, MessageService round trips over a loopback link
+and AsyncMessageService over in-memory asyncio streams.
+
+On a desktop run `python3 benchmark.py`; the QuecPython-only modules are filled in with CPython equivalents first.
+`python3 benchmark.py capture.cap` replays a field capture, without one a capture is recorded in the temp directory.
+"""
+
+import sys
+import gc
+import compat
+
+compat.install()
+
+import utime  # noqa: E402
+from message import Message, Body, Parser, MessageService, Dispatcher  # noqa: E402
+import loopback  # noqa: E402
+import capture  # noqa: E402
+
+PAYLOAD_SIZES = (64, 256, 1024, 4096)
+
+
+def make_payload(size):
+    """json payload about `size` bytes, shaped like our telemetry reports."""
+    payload = {'cmd': 'report', 'imei': '861234567890123', 'ts': 1700000000, 'data': []}
+    while len(Body(payload).dump()) < size:
+        index = len(payload['data'])
+        payload['data'].append({'id': index, 'v': 20 + index * 37 % 100 / 10, 'ok': index % 7 != 0})
+    return payload
+
+
+def make_report(size, seed=1):
+    """json payload about `size` bytes of random gps samples, none of it went into Body.DICTIONARY."""
+    import urandom as random
+    random.seed(seed)
+    payload = {'cmd': 'report', 'imei': '86{:013d}'.format(random.getrandbits(40)), 'seq': seed, 'samples': []}
+    ts = 1700000000 + random.getrandbits(20)
+    while len(Body(payload).dump()) < size:
+        ts += 10
+        payload['samples'].append({
+            'ts': ts, 'lat': round(31 + random.random(), 6), 'lng': round(121 + random.random(), 6),
+            'alt': random.randint(0, 80), 'speed': round(random.random() * 60, 1), 'course': random.randint(0, 359),
+            'sats': random.randint(4, 14), 'rssi': -random.randint(60, 110), 'battery': random.randint(3500, 4200),
+        })
+    return payload
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def alloc_bytes(func, repeat=20):
+    """bytes allocated per call of `func`, gc.mem_alloc on the module, tracemalloc peak on CPython."""
+    if hasattr(gc, 'mem_alloc'):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        for _ in range(repeat):
+            func()
+        rv = (gc.mem_alloc() - before) // repeat
+        gc.enable()
+        return rv
+    try:
+        import tracemalloc
+    except ImportError:
+        return -1
+    tracemalloc.start()
+    total = 0
+    for _ in range(repeat):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        func()
+        total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return total // repeat
+
+
+def timed(func, duration=0.3):
+    """run `func` for about `duration` seconds, return calls per second."""
+    count = 0
+    start = utime.ticks_us()
+    while True:
+        func()
+        count += 1
+        elapsed = utime.ticks_diff(utime.ticks_us(), start)
+        if elapsed >= duration * 1000000:
+            return count * 1000000 / elapsed
+
+
+def report(name, size, fps, frame_size, extra=''):
+    print('{:<22}{:>6} B{:>12.0f} fps{:>12.0f} B/s  {}'.format(name, size, fps, fps * frame_size, extra))
+
+
+def bench_codec(size, codec):
+    msg = Message(make_payload(size), codec=codec)
+    frame = msg.dump()
+    buf = bytearray()
+    name = 'json' if codec == Body.JSON else 'binary'
+
+    def dump_into():
+        msg.dump_into(buf)
+
+    def load():
+        Message.load(frame).payload
+
+    report('dump ' + name, size, timed(msg.dump), len(frame), 'alloc {} B/frame'.format(alloc_bytes(msg.dump)))
+    report('dump_into ' + name, size, timed(dump_into), len(frame), 'alloc {} B/frame'.format(alloc_bytes(dump_into)))
+    relayed = Message.load(frame)  # body already encoded, only the framing allocates.
+
+    def relay_into():
+        relayed.dump_into(buf)
+    report('relay dump ' + name, size, timed(relayed.dump), len(frame),
+           'alloc {} B/frame'.format(alloc_bytes(relayed.dump)))
+    report('relay dump_into ' + name, size, timed(relay_into), len(frame),
+           'alloc {} B/frame'.format(alloc_bytes(relay_into)))
+    report('load ' + name, size, timed(load), len(frame), 'alloc {} B/frame, frame {} B'.format(alloc_bytes(load), len(frame)))
+
+
+def bench_compress(size, codec):
+    """bytes saved by deflate with the preset dictionary against the extra time to dump and load a frame."""
+    import zlib
+    payload = make_report(size)
+    name = 'json' if codec == Body.JSON else 'binary'
+    cost = []
+    for compress in (False, True):
+        msg = Message(payload, codec=codec, compress=compress)
+        frame = msg.dump()
+
+        def load():
+            Message.load(frame).payload
+        cost.append((len(frame), 1000000 / timed(msg.dump), 1000000 / timed(load)))
+    (plain, dump_us, load_us), (packed, zdump_us, zload_us) = cost
+    raw = Body(payload, codec).dump()
+    undictionary = len(raw)
+    if len(raw) >= Body.COMPRESS_THRESHOLD:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, Body.WBITS, 4)  # the same deflate, no dictionary.
+        undictionary = min(len(compressor.compress(raw) + compressor.flush()), len(raw))
+    report('compress ' + name, size, 1000000 / zdump_us, packed,
+           'frame {} -> {} B, saved {:.0f}% ({:.0f}% without dictionary), dump {:+.0f} us, load {:+.0f} us'.format(
+               plain, packed, 100 - packed * 100 / plain, 100 - (plain - len(raw) + undictionary) * 100 / plain,
+               zdump_us - dump_us, zload_us - load_us))
+
+
+def bench_timers(pending=200):
+    """cost a timed wait adds: arming and cancelling its timeout, one osTimer per Waiter before, the shared wheel now."""
+    import osTimer
+    from common import TIMER_WHEEL
+
+    def callback(*args):
+        pass
+
+    def os_timer():
+        timer = osTimer()
+        timer.start(1000, 0, callback)
+        timer.stop()
+
+    def wheel():
+        TIMER_WHEEL.cancel(TIMER_WHEEL.add(1000, callback))
+
+    def os_timers():
+        timers = [osTimer() for _ in range(pending)]
+        for timer in timers:
+            timer.start(1000, 0, callback)
+        for timer in timers:
+            timer.stop()
+
+    def wheel_timers():
+        timers = [TIMER_WHEEL.add(1000, callback) for _ in range(pending)]
+        for timer in timers:
+            TIMER_WHEEL.cancel(timer)
+
+    for name, single, many in (('osTimer', os_timer, os_timers), ('timer wheel', wheel, wheel_timers)):
+        print('{:<22}{:>12.0f} waits/s  {:>6} B/wait with {} pending'.format(
+            name, timed(single), alloc_bytes(many, 3) // pending, pending))
+
+
+def bench_round_trips(count=2000):
+    """Event wait/notify round trips between two threads, timed waits, with and without the Waiter free list."""
+    import _thread
+    from common import Event, Waiter
+    pool_size = Waiter.POOL_SIZE
+    for name, size in (('new Waiter per wait', 0), ('pooled Waiter', pool_size)):
+        Waiter.POOL_SIZE = size
+        ping, pong = Event(), Event()
+        done = [False]
+
+        def peer(ping, pong, done):
+            while not done[0]:
+                if ping.wait(1):
+                    ping.clear()
+                    pong.set()
+        _thread.start_new_thread(peer, (ping, pong, done))
+
+        def round_trip():
+            ping.set()
+            pong.wait(1)
+            pong.clear()
+        for _ in range(50):
+            round_trip()  # warm up, drains the free list when it is off.
+        start = utime.ticks_us()
+        for _ in range(count):
+            round_trip()
+        elapsed = utime.ticks_diff(utime.ticks_us(), start) / 1000000
+        print('{:<22}{:>12.0f} round trips/s  {:>6} B/round trip'.format(
+            name, count / elapsed, alloc_bytes(round_trip, 50)))
+        done[0] = True
+        ping.set()
+    Waiter.POOL_SIZE = pool_size
+
+
+def bench_fan_out(count=2000):
+    """geofence checks of `count` points on a 4 worker pool, one submit per point, one batch, chunked map."""
+    from common import ThreadPoolExecutor
+    from geofence import Point, Circular
+    fence = Circular(Point(117.1, 31.8), 500)
+    points = [Point(117.1 + i * 1e-5, 31.8) for i in range(count)]
+
+    def check(point):
+        return point in fence
+
+    def submit():
+        return [result.get() for result in [executor.submit(check, point) for point in points]]
+
+    def submit_many():
+        return [result.get() for result in executor.submit_many(check, [(point, ) for point in points])]
+
+    def chunked():
+        return list(executor.map(check, points, chunksize=64))
+    executor = ThreadPoolExecutor(4)
+    inside = sum(chunked())
+    for name, func in (('submit', submit), ('submit_many', submit_many), ('map chunksize 64', chunked)):
+        start = utime.ticks_us()
+        func()
+        elapsed = utime.ticks_diff(utime.ticks_us(), start) / 1000000
+        print('{:<22}{:>12.0f} checks/s  {} of {} inside'.format(name, count / elapsed, inside, count))
+    executor.shutdown()
+
+
+def bench_pubsub(count=500, subscribers=3):
+    """publish to `subscribers` callbacks until all `count` messages are delivered, against a thread per callback."""
+    from common import PubSub, Thread
+    delivered = []
+
+    def subscriber():
+        return lambda value: delivered.append(value)  # a distinct callback, the same one subscribed twice gets one call.
+    callbacks = [subscriber() for _ in range(subscribers)]
+    for cb in callbacks:
+        PubSub.subscribe('bench', cb)
+
+    def thread_per_callback(topic, value):
+        for cb in PubSub.TOPIC_MAP[topic]:
+            Thread(target=cb, args=(value, )).start()
+    for name, publish in (('thread per callback', thread_per_callback), ('publish_sync', PubSub.publish_sync),
+                          ('publish', PubSub.publish), ('publish_ordered', PubSub.publish_ordered)):
+        del delivered[:]
+        start = utime.ticks_us()
+        for value in range(count):
+            publish('bench', value)
+        while len(delivered) < count * subscribers:
+            utime.sleep_ms(1)
+        elapsed = utime.ticks_diff(utime.ticks_us(), start) / 1000000
+        print('{:<22}{:>12.0f} messages/s'.format(name, count / elapsed))
+    for cb in callbacks:
+        PubSub.unsubscribe('bench', cb)
+
+
+def bench_topics(count=2000, filters=50):
+    """resolve concrete topics against `filters` wildcard subscriptions, first (trie walk) and then cached."""
+    from common import PubSub
+
+    def on_message():
+        pass
+    subscriptions = ['sensor/{}/+'.format(i) for i in range(filters)] + ['sensor/+/temp', 'net/#']
+    for topic in subscriptions:
+        PubSub.subscribe(topic, on_message)
+    topics = ['sensor/{}/temp'.format(i) for i in range(count)]  # all distinct, the first pass never hits.
+    PubSub.CACHE_SIZE, cache_size = count, PubSub.CACHE_SIZE
+    for name in ('trie walk', 'cached'):
+        start = utime.ticks_us()
+        for topic in topics:
+            PubSub.subscribers(topic)
+        elapsed = utime.ticks_diff(utime.ticks_us(), start) / 1000000
+        print('{:<22}{:>12.0f} topics/s  {} filters'.format(name, count / elapsed, len(subscriptions)))
+    PubSub.CACHE_SIZE = cache_size
+    for topic in subscriptions:
+        PubSub.unsubscribe(topic, on_message)
+
+
+def bench_scheduler(count=200):
+    """`count` delayed jobs, lateness against the due time, thread per job (Thread.start delay) vs the scheduler."""
+    import urandom as random
+    from common import Thread, Scheduler
+    scheduler = Scheduler()
+    delays = [random.randint(10, 200) for _ in range(count)]
+    for name in ('Thread.start(delay)', 'Scheduler.call_later'):
+        lateness = []
+
+        def job(due):
+            lateness.append(utime.ticks_diff(utime.ticks_ms(), due))
+        start = utime.ticks_ms()
+        for delay in delays:
+            due = utime.ticks_add(start, delay)
+            if name == 'Scheduler.call_later':
+                scheduler.call_later(delay, job, due)
+            else:
+                Thread(target=job, args=(due, )).start(delay / 1000)
+        while len(lateness) < count:
+            utime.sleep_ms(10)
+        print('{:<22}late p50 {:>4} ms  p99 {:>4} ms'.format(
+            name, percentile(lateness, 50), percentile(lateness, 99)))
+
+
+def bench_parser(size):
+    frame = Message(make_payload(size)).dump()
+    stream = frame * max(1, 8192 // len(frame))
+    frames = len(stream) // len(frame)
+    parser = Parser()
+
+    def parse():
+        for index in range(0, len(stream), 1024):
+            parser.parse(stream[index:index + 1024])
+        parser.messages
+
+    report('parse', size, timed(parse) * frames, len(frame), 'alloc {} B/frame'.format(alloc_bytes(parse, 5) // frames))
+
+
+def service_pair(latency=0, bandwidth=0, bit_error_rate=0.0, window=8, fragment_size=0):
+    a, b = loopback.pair(latency, bandwidth, bit_error_rate)
+    client = MessageService(window=window, fragment_size=fragment_size)
+    server = MessageService(fragment_size=fragment_size)
+    server.dispatcher = Dispatcher(workers=1)
+    server.dispatcher.register('report', lambda msg: {'ok': True})  # acked by the handler return value.
+    client.init(a)
+    server.init(b)
+    return client, server, a
+
+
+def bench_roundtrip(size, count=100, **link):
+    client, server, stream = service_pair(**link)
+    payload = make_payload(size)
+    latencies = []
+    lost = 0
+    start = utime.ticks_us()
+    for _ in range(count):
+        sent = utime.ticks_us()
+        if client.send(Message(payload), timeout=2) is None:
+            lost += 1
+        latencies.append(utime.ticks_diff(utime.ticks_us(), sent) / 1000)
+    elapsed = utime.ticks_diff(utime.ticks_us(), start) / 1000000
+    report('send+ack', size, count / elapsed, stream.bytes_written / count,
+           'p50 {:.2f} ms, p99 {:.2f} ms, lost {}'.format(percentile(latencies, 50), percentile(latencies, 99), lost))
+    client.deinit()
+    server.deinit()
+
+
+def bench_window(size, count=200, **link):
+    client, server, stream = service_pair(**link)
+    payload = make_payload(size)
+    start = utime.ticks_us()
+    results = [client.post(Message(payload), timeout=1) for _ in range(count)]
+    failed = 0
+    for result in results:
+        try:
+            result.get()
+        except Exception:
+            failed += 1
+    elapsed = utime.ticks_diff(utime.ticks_us(), start) / 1000000
+    report('post (window 8)', size, count / elapsed, stream.bytes_written / count, 'failed {}'.format(failed))
+    client.deinit()
+    server.deinit()
+
+
+def bench_channels(bulk_channel, count=50, producers=3, **link):
+    """send+ack latency of small control messages on channel 0 while threads send bulk payloads on `bulk_channel`."""
+    import _thread
+    client, server, stream = service_pair(fragment_size=512, **link)  # bulk bodies go out in 512 B turns.
+    if bulk_channel:
+        client.channels[0].weight = server.channels[0].weight = 4
+        client.open_channel(bulk_channel)
+        server.open_channel(bulk_channel)
+    bulk = make_payload(4096)
+    running = [True, 0]  # [keep sending, producers finished]
+
+    def load():
+        while running[0]:
+            client.send(Message(bulk, channel=bulk_channel), timeout=1)
+        running[1] += 1
+    for _ in range(producers):
+        _thread.start_new_thread(load, ())
+    utime.sleep_ms(100)
+    control = make_payload(64)
+    latencies = []
+    for _ in range(count):
+        sent = utime.ticks_us()
+        client.send(Message(control), timeout=2)
+        latencies.append(utime.ticks_diff(utime.ticks_us(), sent) / 1000)
+    running[0] = False
+    while running[1] < producers:
+        utime.sleep_ms(10)
+    report('control, bulk on ch {}'.format(bulk_channel), 64, count * 1000 / sum(latencies), 0,
+           'p50 {:.2f} ms, p99 {:.2f} ms'.format(percentile(latencies, 50), percentile(latencies, 99)))
+    client.deinit()
+    server.deinit()
+
+
+def record_capture(path, count=300):
+    """capture what a server reads of `count` mixed size reports, a stand-in for a field capture."""
+    client, server, stream = service_pair()
+    server.capture = capture.CaptureWriter(path)
+    payloads = [make_payload(size) for size in PAYLOAD_SIZES]
+    results = [client.post(Message(payloads[index % len(payloads)]), timeout=1) for index in range(count)]
+    for result in results:
+        try:
+            result.get()
+        except Exception:
+            pass
+    client.deinit()
+    server.deinit()
+    server.capture.close()
+
+
+def bench_replay(path):
+    """replay a capture as fast as possible into a Parser, then through a MessageService."""
+    cap = capture.Capture(path)
+    frames = cap.frame_count
+    start = utime.ticks_us()
+    size = cap.replay(Parser())
+    elapsed = utime.ticks_diff(utime.ticks_us(), start) / 1000000
+    report('replay parse', size // max(frames, 1), frames / elapsed, size / frames, '{} frames, {} B'.format(frames, size))
+
+    service = MessageService()
+    stream = capture.ReplayStream(cap)
+    received = [0]
+    service.dispatcher.register('report', lambda msg: received.__setitem__(0, received[0] + 1))
+    start = utime.ticks_us()
+    service.init(stream)
+    while not stream.finished:
+        utime.sleep_ms(1)
+    elapsed = utime.ticks_diff(utime.ticks_us(), start) / 1000000
+    service.deinit()
+    report('replay service', size // max(frames, 1), frames / elapsed, size / frames,
+           'dispatched {}, acks written {} B'.format(received[0], stream.bytes_written))
+    frame = frames // 2
+    start = utime.ticks_us()
+    cap.replay(Parser(), frame=frame)
+    print('seek to frame {} at {} ms, replay rest in {:.1f} ms'.format(
+        frame, cap.entry(frame)[2], utime.ticks_diff(utime.ticks_us(), start) / 1000))
+    cap.close()
+
+
+class _MemoryWriter(object):
+    """asyncio StreamWriter look-alike feeding the peer's StreamReader directly."""
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.reader.feed_data(bytes(data))
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.reader.feed_eof()
+
+
+def bench_async(size, count=200):
+    try:
+        import asyncio
+        from async_message import AsyncMessageService
+    except ImportError:
+        return
+
+    async def main():
+        client_reader, server_reader = asyncio.StreamReader(), asyncio.StreamReader()
+        writer = _MemoryWriter(server_reader)
+        client = await AsyncMessageService.open(client_reader, writer)
+        server = await AsyncMessageService.open(server_reader, _MemoryWriter(client_reader))
+
+        async def serve():
+            async for msg in server:
+                await server.send(Message({'ok': True}, ack=True, serial_number=msg.serial_number), timeout=0)
+        task = asyncio.ensure_future(serve())
+
+        payload = make_payload(size)
+        latencies = []
+        start = utime.ticks_us()
+        for _ in range(count):
+            sent = utime.ticks_us()
+            await client.send(Message(payload), timeout=2)
+            latencies.append(utime.ticks_diff(utime.ticks_us(), sent) / 1000)
+        elapsed = utime.ticks_diff(utime.ticks_us(), start) / 1000000
+        report('async send+ack', size, count / elapsed, writer.bytes_written / count,
+               'p50 {:.2f} ms, p99 {:.2f} ms'.format(percentile(latencies, 50), percentile(latencies, 99)))
+        await client.close()
+        await server.close()
+        task.cancel()
+
+    asyncio.run(main())
+
+
+def run():
+    print('--- codec, frame encode / decode ---')
+    for size in PAYLOAD_SIZES:
+        for codec in (Body.JSON, Body.BINARY):
+            bench_codec(size, codec)
+    print('--- body compression, deflate with preset dictionary ---')
+    for size in PAYLOAD_SIZES:
+        for codec in (Body.JSON, Body.BINARY):
+            bench_compress(size, codec)
+    print('--- timed wait, arm and cancel the timeout ---')
+    bench_timers()
+    print('--- wait/notify between threads ---')
+    bench_round_trips()
+    print('--- delayed jobs, 10-200 ms ---')
+    bench_scheduler()
+    print('--- fan-out on the thread pool ---')
+    bench_fan_out()
+    print('--- pubsub, 3 subscribers ---')
+    bench_pubsub()
+    bench_topics()
+    print('--- parser, 1024 B reads ---')
+    for size in PAYLOAD_SIZES:
+        bench_parser(size)
+    print('--- service over loopback, no latency ---')
+    for size in PAYLOAD_SIZES:
+        bench_roundtrip(size)
+        bench_async(size)
+        bench_window(size)
+    print('--- service over loopback, 5 ms latency, 115200 baud, ber 1e-6 ---')
+    link = dict(latency=5, bandwidth=11520, bit_error_rate=1e-6)
+    for size in PAYLOAD_SIZES[:2]:
+        bench_roundtrip(size, count=20, **link)
+        bench_window(size, count=50, **link)
+    print('--- capture replay ---')
+    if len(sys.argv) > 1:
+        path = sys.argv[1]  # a field capture.
+    else:
+        try:
+            import tempfile
+            path = tempfile.gettempdir() + '/benchmark.cap'
+        except ImportError:
+            path = '/usr/benchmark.cap'  # the module has no temp directory, /usr is its user file system.
+        record_capture(path)
+    bench_replay(path)
+    print('--- control latency under bulk load, 115200 baud ---')
+    for bulk_channel in (0, 1):
+        bench_channels(bulk_channel, latency=5, bandwidth=11520)
+
+
+if __name__ == '__main__':
+    run()
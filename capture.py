@@ -0,0 +1,207 @@
+"""
+UART capture and replay.
+
+A capture file is b'QCAP' + version, then one record per read: ustruct '>IH' (ms since the capture started,
+length) and the bytes read. The index file next to it, path + '.idx', is b'QIDX' + version, then one '>IHI' entry
+(record offset, offset in the record, ms) for every frame that loads, at its opening 0x7E, so frame n is at a fixed
+position. Like the parser, a 0x7E closing something that does not load opens the next frame instead, a capture started
+mid-frame or a stray 0x7E on a noisy line costs one frame, not the rest of the index.
+"""
+
+import utime
+import ustruct as struct
+from message import Message, FormatError, ValidateError
+
+MAGIC = b'QCAP\x01'
+INDEX_MAGIC = b'QIDX\x01'
+RECORD = '>IH'
+RECORD_SIZE = struct.calcsize(RECORD)
+ENTRY = '>IHI'
+ENTRY_SIZE = struct.calcsize(ENTRY)
+MAX_FRAME = 0x4000  # longer runs without a frame that loads are noise, the index skips them.
+
+
+class CaptureError(Exception):
+    pass
+
+
+def _pace(start, ms, speed):
+    """sleep until the read captured at `ms` is due, returns the replay start to pass on the next call."""
+    offset = int(ms / speed)
+    if start is None:
+        return utime.ticks_add(utime.ticks_ms(), -offset)
+    wait = utime.ticks_diff(utime.ticks_add(start, offset), utime.ticks_ms())
+    if wait > 0:
+        utime.sleep_ms(wait)
+    return start
+
+
+class CaptureWriter(object):
+    """set as `MessageService.capture`, every raw read of the service is recorded."""
+
+    def __init__(self, path, index=True):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.index_file = None
+        if index:
+            self.index_file = open(path + '.idx', 'wb')
+            self.index_file.write(INDEX_MAGIC)
+        self.offset = len(MAGIC)
+        self.start = utime.ticks_ms()
+        self.pending = None  # bytes from the 0x7E that may open a frame, None when there is none.
+        self.header = None  # index entry of that 0x7E.
+        self.frame_count = 0
+
+    def write(self, data):
+        while len(data) > 0xFFFF:
+            self.write(data[:0xFFFF])
+            data = data[0xFFFF:]
+        ms = utime.ticks_diff(utime.ticks_ms(), self.start)
+        self.file.write(struct.pack(RECORD, ms, len(data)))
+        self.file.write(data)
+        if self.index_file is not None:
+            self.__index(data, ms)
+        self.offset += RECORD_SIZE + len(data)
+
+    def __index(self, data, ms):
+        start = 0
+        index = data.find(b'\x7E')
+        while index != -1:
+            if self.pending is not None:
+                self.pending.extend(data[start:index + 1])
+                if self.__loads(self.pending):
+                    self.index_file.write(struct.pack(ENTRY, *self.header))
+                    self.frame_count += 1
+                    self.pending = None
+                    start = index + 1
+                    index = data.find(b'\x7E', start)
+                    continue
+            self.pending = bytearray(b'\x7E')  # opens the next frame, or resyncs on it like the parser.
+            self.header = (self.offset, index, ms)
+            start = index + 1
+            index = data.find(b'\x7E', start)
+        if self.pending is not None:
+            self.pending.extend(data[start:])
+            if len(self.pending) > MAX_FRAME:
+                self.pending = None
+
+    @staticmethod
+    def __loads(frame):
+        if len(frame) == 2:
+            return False  # 0x7E 0x7E, the second one opens the frame.
+        try:
+            Message.load_from(bytes(frame))
+        except (FormatError, ValidateError):
+            return False
+        return True
+
+    def close(self):
+        self.file.close()
+        if self.index_file is not None:
+            self.index_file.close()
+
+
+class Capture(object):
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise CaptureError('{} is not a capture.'.format(path))
+        try:
+            self.index_file = open(path + '.idx', 'rb')
+        except OSError:
+            self.index_file = None  # no seeking, replay from the start only.
+        else:
+            if self.index_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise CaptureError('{}.idx is not a capture index.'.format(path))
+
+    @property
+    def frame_count(self):
+        if self.index_file is None:
+            return 0
+        self.index_file.seek(0, 2)
+        return (self.index_file.tell() - len(INDEX_MAGIC)) // ENTRY_SIZE
+
+    def entry(self, frame):
+        """(record offset, offset in the record, ms) of the `frame`th frame."""
+        if not 0 <= frame < self.frame_count:
+            raise CaptureError('frame {} out of [0, {}).'.format(frame, self.frame_count))
+        self.index_file.seek(len(INDEX_MAGIC) + frame * ENTRY_SIZE)
+        return struct.unpack(ENTRY, self.index_file.read(ENTRY_SIZE))
+
+    def frame_at(self, ms):
+        """first frame captured at or after `ms`, binary search over the index."""
+        low, high = 0, self.frame_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[2] < ms:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def records(self, frame=0):
+        """yield (ms, data) of the reads, from the one holding the `frame`th frame on."""
+        skip = 0
+        if frame:
+            offset, skip, _ = self.entry(frame)
+            self.file.seek(offset)
+        else:
+            self.file.seek(len(MAGIC))
+        while True:
+            head = self.file.read(RECORD_SIZE)
+            if len(head) < RECORD_SIZE:
+                return
+            ms, size = struct.unpack(RECORD, head)
+            data = self.file.read(size)
+            if skip:
+                data, skip = data[skip:], 0
+            yield ms, data
+
+    def replay(self, parser, speed=0, frame=0):
+        """
+        feed the capture into `parser`, or anything with `parse(data)`.
+        :param speed: 0 for as fast as possible, 1 for the captured timing, 2 for twice as fast.
+        """
+        size = 0
+        start = None
+        for ms, data in self.records(frame):
+            if speed:
+                start = _pace(start, ms, speed)
+            parser.parse(data)
+            size += len(data)
+        return size
+
+    def close(self):
+        self.file.close()
+        if self.index_file is not None:
+            self.index_file.close()
+
+
+class ReplayStream(object):
+    """stand-in for `serial.Serial`, reads come from a capture, writes are counted and dropped."""
+
+    def __init__(self, capture, speed=0, frame=0):
+        self.records = capture.records(frame)
+        self.speed = speed
+        self.start = None
+        self.pending = b''
+        self.bytes_written = 0
+        self.finished = False
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+    def read(self, size, timeout=0):
+        if not self.pending:
+            try:
+                ms, self.pending = next(self.records)
+            except StopIteration:
+                self.finished = True
+                if timeout != 0:
+                    utime.sleep_ms(timeout if timeout > 0 else 10)
+                return b''
+            if self.speed:
+                self.start = _pace(self.start, ms, self.speed)
+        rv, self.pending = self.pending[:size], self.pending[size:]
+        return rv
@@ -1,13 +1,21 @@
 import utime
 import usys
+import uheapq as heapq
 import _thread
-import osTimer
 from queue import Queue
 
 
 Lock = _thread.allocate_lock
 
 
+class TimeoutError(Exception):
+    pass
+
+
+class RejectedError(Exception):
+    pass
+
+
 class Singleton(object):
     def __init__(self, cls):
         self.cls = cls
@@ -23,67 +31,124 @@ class Singleton(object):
 
 
 class Waiter(object):
+    """one shot: acquire blocks until release or timeout, a release before acquire is not lost."""
+    WAITING = 0
+    RELEASED = 1
+    TIMEOUT = 2
+    POOL_SIZE = 32
+    __pool = []  # free list of waiters ready for another wait.
+    __pool_lock = Lock()
 
     def __init__(self):
         self.__lock = _thread.allocate_lock()
-        self.__unlock_timer = osTimer()
-        self.__gotit = True
+        self.__lock.acquire()  # held until released.
+        self.__guard = _thread.allocate_lock()  # only one of release and timeout gets through.
+        self.__state = self.WAITING
+        self.prev = None  # links of the Condition it waits in.
+        self.next = None
+        self.linked = False
 
-    def __auto_release(self, _):
-        self.__gotit = False
-        if not self.__release():
-            self.__gotit = True
+    @classmethod
+    def get(cls):
+        with cls.__pool_lock:
+            if cls.__pool:
+                return cls.__pool.pop()
+        return cls()
+
+    def recycle(self):
+        """back to the free list after acquire returned, only when nobody can release it any more."""
+        self.__state = self.WAITING
+        with Waiter.__pool_lock:
+            if len(Waiter.__pool) < self.POOL_SIZE:
+                Waiter.__pool.append(self)
+
+    def __signal(self, state):
+        with self.__guard:
+            if self.__state != self.WAITING:
+                return False
+            self.__state = state
+            self.__lock.release()
+        return True
 
-    def __acquire(self):
-        return self.__lock.acquire()
+    def __auto_release(self):
+        self.__signal(self.TIMEOUT)
 
     def acquire(self, timeout=-1):
-        self.__lock.acquire()
-        self.__gotit = True
-        if timeout > 0:
-            self.__unlock_timer.start(timeout * 1000, 0, self.__auto_release)
-        self.__acquire()  # block here
+        timer = None
         if timeout > 0:
-            self.__unlock_timer.stop()
-        self.__release()
-        return self.__gotit
-
-    def __release(self):
-        try:
-            self.__lock.release()
-        except RuntimeError:
-            return False
-        return True
+            timer = TIMER_WHEEL.add(timeout * 1000, self.__auto_release)
+        self.__lock.acquire()  # block here
+        if timer is not None:
+            TIMER_WHEEL.cancel(timer)
+        return self.__state == self.RELEASED
 
     def release(self):
-        return self.__release()
+        return self.__signal(self.RELEASED)
 
 
 class Condition(object):
 
     def __init__(self):
         self.__lock = _thread.allocate_lock()
-        self.__waiters = []
-
-    def wait(self, timeout=-1):
-        waiter = Waiter()
+        self.__head = None  # waiters oldest first, linked through Waiter.prev and Waiter.next.
+        self.__tail = None
+
+    def __link(self, waiter):
+        waiter.prev = self.__tail
+        waiter.next = None
+        if self.__tail is None:
+            self.__head = waiter
+        else:
+            self.__tail.next = waiter
+        self.__tail = waiter
+        waiter.linked = True
+
+    def __unlink(self, waiter):
+        if not waiter.linked:
+            return
+        if waiter.prev is None:
+            self.__head = waiter.next
+        else:
+            waiter.prev.next = waiter.next
+        if waiter.next is None:
+            self.__tail = waiter.prev
+        else:
+            waiter.next.prev = waiter.prev
+        waiter.prev = waiter.next = None
+        waiter.linked = False
+
+    def wait(self, timeout=-1, predicate=None):
+        """
+        :param predicate: checked under the condition lock before waiting, a notify right after it is not missed.
+        """
+        waiter = Waiter.get()
         with self.__lock:
-            self.__waiters.append(waiter)
+            if predicate is not None and predicate():
+                waiter.recycle()
+                return True
+            self.__link(waiter)
         gotit = waiter.acquire(timeout)
-        with self.__lock:
-            self.__waiters.remove(waiter)
+        if not gotit:
+            with self.__lock:
+                self.__unlink(waiter)  # notify unlinks the ones it wakes.
+        waiter.recycle()
         return gotit
 
     def notify(self, n=1):
         if n <= 0:
             raise ValueError('invalid param, n should be > 0.')
         with self.__lock:
-            for waiter in self.__waiters[:n]:
-                waiter.release()
+            while n and self.__head is not None:
+                waiter = self.__head
+                self.__unlink(waiter)
+                if waiter.release():
+                    n -= 1  # a waiter timing out right now does not count.
 
     def notify_all(self):
         with self.__lock:
-            for waiter in self.__waiters:
+            while self.__head is not None:
+                waiter = self.__head
+                self.__unlink(waiter)
                 waiter.release()
 
 
@@ -97,13 +162,13 @@ class Event(object):
     def wait(self, timeout=-1):
         signaled = self.is_set()
         if not signaled:
-            signaled = self.cond.wait(timeout)
+            signaled = self.cond.wait(timeout, predicate=self.is_set)
         return signaled
 
     def set(self):
         with self.__lock:
             self.flag = True
-            self.cond.notify_all()
+        self.cond.notify_all()  # outside the lock, wait checks is_set holding the condition lock.
 
     def clear(self):
         with self.__lock:
@@ -175,6 +240,119 @@ class Thread(object):
             result.set(None, rv)
 
 
+class _Timer(object):
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.expires = 0  # wheel tick
+        self.slot = None  # set holding it while pending.
+
+
+class TimerWheel(object):
+    """
+    hierarchical timing wheel, one thread advances it every `tick` ms and fires what is due.
+    LEVELS wheels of SLOTS slots each, level n covers SLOTS ** (n + 1) ticks, later timers wait in the last level.
+    callbacks run on the wheel thread holding its lock, they must be short, must not block and must not add or cancel.
+    """
+    SLOTS = 64
+    BITS = 6  # log2(SLOTS)
+    LEVELS = 3
+
+    def __init__(self, tick=10):
+        self.tick = tick
+        self.lock = Lock()
+        self.wheels = [[set() for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+        self.now = 0  # ticks advanced
+        self.last = utime.ticks_ms()  # ms of the last tick
+        self.count = 0
+        self.idle = Lock()  # the thread sleeps on it while no timer is pending.
+        self.idle.acquire()
+        self.thread = None
+
+    def add(self, delay, callback):
+        """call `callback()` after `delay` ms, rounded up to whole ticks."""
+        timer = _Timer(callback)
+        with self.lock:
+            if self.count == 0:
+                self.last = utime.ticks_ms()  # time did not advance while idle.
+            timer.expires = self.now + max(1, int((delay + self.tick - 1) // self.tick))
+            self.__place(timer)
+            self.count += 1
+            wake = self.count == 1
+            if self.thread is None:
+                self.thread = Thread(target=self.__run)
+                self.thread.start()
+        if wake:
+            try:
+                self.idle.release()
+            except RuntimeError:
+                pass  # a wake up is pending already.
+        return timer
+
+    def cancel(self, timer):
+        """False if it fired already."""
+        with self.lock:
+            if timer.slot is None:
+                return False
+            timer.slot.remove(timer)
+            timer.slot = None
+            self.count -= 1
+            return True
+
+    def __place(self, timer):
+        bits = self.BITS
+        for level in range(self.LEVELS):
+            shift = bits * level
+            index = timer.expires >> shift
+            if index - (self.now >> shift) < self.SLOTS or level == self.LEVELS - 1:
+                index = min(index, (self.now >> shift) + self.SLOTS - 1)  # too far, placed again on cascade.
+                timer.slot = self.wheels[level][index & (self.SLOTS - 1)]
+                timer.slot.add(timer)
+                return
+
+    def __advance(self):
+        self.now += 1
+        now = self.now
+        mask = self.SLOTS - 1
+        for level in range(1, self.LEVELS):
+            shift = self.BITS * level
+            if now & ((1 << shift) - 1):
+                break
+            slot = self.wheels[level][(now >> shift) & mask]
+            if slot:
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    self.__place(timer)  # down to a finer wheel.
+        slot = self.wheels[0][now & mask]
+        if not slot:
+            return None
+        due = list(slot)
+        slot.clear()
+        for timer in due:
+            timer.slot = None
+        self.count -= len(due)
+        return due
+
+    def __run(self):
+        while True:
+            if self.count == 0:
+                self.idle.acquire()
+            utime.sleep_ms(self.tick)
+            with self.lock:
+                ticks = utime.ticks_diff(utime.ticks_ms(), self.last) // self.tick
+                self.last = utime.ticks_add(self.last, ticks * self.tick)
+                for _ in range(ticks):
+                    for timer in self.__advance() or ():
+                        try:
+                            timer.callback()  # under the lock, once cancel returns the callback is done.
+                        except Exception as e:
+                            usys.print_exception(e)
+
+
+TIMER_WHEEL = TimerWheel()
+
+
 class _WorkItem(object):
 
     def __init__(self, fn, args, kwargs):
@@ -189,29 +367,151 @@ class _WorkItem(object):
         except Exception as e:
             self.result.set(e, None)
         else:
-            self.result.set(rv, None)
+            self.result.set(None, rv)
+
+
+class _WorkQueue(object):
+    """fifo of work items, `put` takes a whole batch under one lock, `waiting` counts the idle getters."""
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize  # 0 for unbounded.
+        self.waiting = 0
+        self.__items = []
+        self.__head = 0  # items before it are taken, dropped once they are half of the list.
+        self.__lock = _thread.allocate_lock()
+        self.__not_empty = Condition()
+        self.__not_full = Condition()
+
+    def size(self):
+        return len(self.__items) - self.__head
+
+    def __has_items(self):
+        return self.size() > 0
+
+    def __has_room(self):
+        return self.size() < self.maxsize
+
+    def put(self, items, start=0):
+        """put what fits of items[start:], returns the index after the last one put."""
+        with self.__lock:
+            room = len(items) - start
+            if self.maxsize:
+                room = min(room, self.maxsize - self.size())
+            if room <= 0:
+                return start
+            self.__items.extend(items[start:start + room])
+        self.__not_empty.notify(room)
+        return start + room
+
+    def wait_room(self):
+        self.__not_full.wait(predicate=self.__has_room)
+
+    def get(self):
+        idle = False
+        while True:
+            with self.__lock:
+                if self.__head < len(self.__items):
+                    item = self.__items[self.__head]
+                    self.__items[self.__head] = None
+                    self.__head += 1
+                    if self.__head >= 32 and self.__head * 2 >= len(self.__items):
+                        del self.__items[:self.__head]
+                        self.__head = 0
+                    if idle:
+                        self.waiting -= 1
+                    break
+                if not idle:
+                    idle = True
+                    self.waiting += 1
+            self.__not_empty.wait(predicate=self.__has_items)
+        if self.maxsize:
+            self.__not_full.notify()
+        return item
 
 
 class ThreadPoolExecutor(object):
 
-    def __init__(self, max_workers=4):
+    def __init__(self, max_workers=4, max_queue=0, block=True):
+        """
+        :param max_queue: most items waiting for a worker, 0 for unbounded.
+        :param block: when the queue is full, submit waits for room, or raises RejectedError if False.
+            submit_many and map then queue what fits, the results of the others raise RejectedError.
+        """
         if max_workers <= 0:
             raise ValueError("max_workers must be greater than 0")
         self.__max_workers = max_workers
-        self.__worker_queue = Queue()
+        self.__worker_queue = _WorkQueue(max_queue)
+        self.__block = block
         self.__threads = set()
         self.__lock = Lock()
 
     def submit(self, fn, *args, **kwargs):
         item = _WorkItem(fn, args, kwargs)
-        self.__worker_queue.put(item)
-        self.__adjust_thread_count()
+        if not self.__put((item, )):
+            raise self.__rejected()
         return item.result
 
+    def submit_many(self, fn, iterable):
+        """fn(*args) for each args in `iterable`, all enqueued at once, returns the results in the same order."""
+        items = [_WorkItem(fn, args, {}) for args in iterable]
+        index = self.__put(items)
+        if index < len(items):
+            error = self.__rejected()
+            for item in items[index:]:
+                item.result.set(error, None)
+        return [item.result for item in items]
+
+    def map(self, fn, iterable, chunksize=1, timeout=-1):
+        """
+        like the builtin map, but fn runs on the workers `chunksize` items per work item.
+        :param timeout: seconds to wait for each chunk, as _Result.get, _Result.TimeoutError once it is over.
+        """
+        if chunksize <= 0:
+            raise ValueError("chunksize must be greater than 0")
+        chunks = []
+        chunk = []
+        for value in iterable:
+            chunk.append(value)
+            if len(chunk) == chunksize:
+                chunks.append((fn, chunk))
+                chunk = []
+        if chunk:
+            chunks.append((fn, chunk))
+        results = self.submit_many(self.__run_chunk, chunks)
+        return self.__chain(results, timeout)
+
+    @staticmethod
+    def __run_chunk(fn, chunk):
+        return [fn(value) for value in chunk]
+
+    @staticmethod
+    def __chain(results, timeout):
+        for result in results:
+            for rv in result.get(timeout):
+                yield rv
+
+    def __put(self, items):
+        """returns how many of `items` are queued, all of them unless the queue is full and block is False."""
+        queue = self.__worker_queue
+        index = queue.put(items)
+        self.__adjust_thread_count()
+        while index < len(items) and self.__block:  # full, the workers make room.
+            queue.wait_room()
+            index = queue.put(items, index)
+            self.__adjust_thread_count()
+        return index
+
+    def __rejected(self):
+        return RejectedError('work queue full, max_queue is {}.'.format(self.__worker_queue.maxsize))
+
     def __adjust_thread_count(self):
+        queue = self.__worker_queue
+        if queue.size() <= queue.waiting or len(self.__threads) >= self.__max_workers:
+            return  # idle workers take it, no lock on this path.
         with self.__lock:
-            if len(self.__threads) < self.__max_workers:
-                t = Thread(target=self.__worker, args=(self.__worker_queue, ))
+            spawn = min(queue.size() - queue.waiting, self.__max_workers - len(self.__threads))
+            for _ in range(spawn):
+                t = Thread(target=self.__worker, args=(queue, ))
                 t.start()
                 self.__threads.add(t)
 
@@ -231,20 +531,305 @@ class ThreadPoolExecutor(object):
             self.__threads.clear()
 
 
+class _Job(object):
+
+    def __init__(self, due, period, fn, args, kwargs):
+        self.due = due  # ms on the scheduler clock.
+        self.period = period  # ms, 0 for once.
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.queued = False  # in the heap.
+        self.started = False
+        self.missed = 0  # periodic ticks skipped because the previous run was late.
+
+
+class Scheduler(object):
+    """
+    delayed and periodic jobs, one thread keeps them in a heap by due time and runs the due ones on `executor`.
+    a periodic job is due again only once its run is over, ticks missed meanwhile are skipped, not run in a burst.
+    """
+
+    def __init__(self, executor=None):
+        self.executor = executor or ThreadPoolExecutor()
+        self.__lock = Lock()
+        self.__heap = []  # (due, seq, job)
+        self.__seq = 0  # keeps jobs due at the same ms in order.
+        self.__cancelled = 0  # still in the heap, dropped when popped.
+        self.__clock = 0  # ms since start, does not wrap like ticks_ms.
+        self.__last = utime.ticks_ms()
+        self.__woken = False
+        self.__wakeup = Condition()
+        self.__thread = None
+
+    def __now(self):
+        now = utime.ticks_ms()
+        self.__clock += utime.ticks_diff(now, self.__last)
+        self.__last = now
+        return self.__clock
+
+    def __is_woken(self):
+        return self.__woken
+
+    def __push(self, job):
+        heapq.heappush(self.__heap, (job.due, self.__seq, job))
+        self.__seq += 1
+        job.queued = True
+        if self.__heap[0][2] is job:
+            self.__woken = True  # earlier than what the thread waits for.
+            return True
+        return False
+
+    def __schedule(self, delay, period, fn, args, kwargs):
+        with self.__lock:
+            job = _Job(self.__now() + max(0, int(delay)), period, fn, args, kwargs)
+            wake = self.__push(job)
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run)
+                self.__thread.start()
+        if wake:
+            self.__wakeup.notify()
+        return job
+
+    def call_later(self, delay, fn, *args, **kwargs):
+        """fn(*args, **kwargs) once after `delay` ms, returns the job to cancel."""
+        return self.__schedule(delay, 0, fn, args, kwargs)
+
+    def call_at(self, ticks, fn, *args, **kwargs):
+        """fn(*args, **kwargs) once when utime.ticks_ms() reaches `ticks`."""
+        return self.__schedule(utime.ticks_diff(ticks, utime.ticks_ms()), 0, fn, args, kwargs)
+
+    def call_every(self, period, fn, *args, **kwargs):
+        """fn(*args, **kwargs) every `period` ms, the first time one period from now."""
+        period = int(period)  # whole ms, 0 would be a job that runs once.
+        if period <= 0:
+            raise ValueError('period must be at least 1 ms')
+        return self.__schedule(period, period, fn, args, kwargs)
+
+    def cancel(self, job):
+        """False if it was cancelled already or, once only, started already."""
+        with self.__lock:
+            if job.cancelled:
+                return False
+            job.cancelled = True
+            if job.queued:
+                self.__cancelled += 1
+                if self.__cancelled * 2 > len(self.__heap):
+                    for entry in self.__heap:
+                        entry[2].queued = not entry[2].cancelled
+                    self.__heap = [entry for entry in self.__heap if entry[2].queued]
+                    heapq.heapify(self.__heap)
+                    self.__cancelled = 0
+            return not job.started or job.period > 0  # a periodic one running now is not due again.
+
+    def __run(self):
+        while True:
+            due = []
+            with self.__lock:
+                now = self.__now()
+                while self.__heap and self.__heap[0][0] <= now:
+                    job = heapq.heappop(self.__heap)[2]
+                    job.queued = False
+                    if job.cancelled:
+                        self.__cancelled -= 1
+                    else:
+                        due.append(job)
+                wait = (self.__heap[0][0] - now) / 1000 if self.__heap else -1
+                self.__woken = False
+            for job in due:
+                try:
+                    self.executor.submit(self.__execute, job)
+                except RejectedError:
+                    self.__execute(job)  # executor is full, run it here.
+            if not due:
+                self.__wakeup.wait(wait, predicate=self.__is_woken)
+
+    def __execute(self, job):
+        with self.__lock:
+            if job.cancelled:
+                return
+            job.started = True
+        try:
+            job.fn(*job.args, **job.kwargs)
+        except Exception as e:
+            usys.print_exception(e)
+        if not job.period:
+            return
+        with self.__lock:
+            if job.cancelled:
+                return
+            now = self.__now()
+            job.due += job.period
+            if job.due <= now:
+                skipped = (now - job.due) // job.period + 1
+                job.missed += skipped
+                job.due += skipped * job.period
+            wake = self.__push(job)
+        if wake:
+            self.__wakeup.notify()
+
+
+SCHEDULER = Scheduler()
+
+
+class _TopicNode(object):
+
+    def __init__(self):
+        self.children = {}  # level -> _TopicNode, '+' and '#' included.
+        self.callbacks = ()  # of the filter ending here.
+
+
 class PubSub(object):
-    TOPIC_MAP = {}
+    """
+    publish runs the subscribers on one shared bounded pool, publish_sync on the publisher thread,
+    publish_ordered one message of a topic after another. when the pool queue is full the publisher runs them itself.
+    topics are levels joined by '/', subscribe takes mqtt style filters: '+' for one level, a last '#' for the rest.
+    """
+    TOPIC_MAP = {}  # filter -> tuple of callbacks, the same tuples the trie holds.
     PUBSUB_LOCK = Lock()
+    MAX_WORKERS = 4
+    MAX_QUEUE = 32
+    CACHE_SIZE = 64
+    __root = _TopicNode()
+    __resolved = {}  # topic -> tuple of the callbacks it resolves to, replaced on every change, read without the lock.
+    __executor = None
+    __ordered = {}  # topic -> [(callbacks, args, kwargs), ...] waiting while a drain of the topic is running.
+    __ordered_lock = Lock()
+
+    @staticmethod
+    def __check(topic):
+        levels = topic.split('/')
+        for index, level in enumerate(levels):
+            if ('+' in level or '#' in level) and level not in ('+', '#'):
+                raise ValueError('wildcard must be a whole level: {}'.format(topic))
+            if level == '#' and index != len(levels) - 1:
+                raise ValueError('# must be the last level: {}'.format(topic))
+        return levels
 
     @classmethod
     def subscribe(cls, topic, callback):
+        levels = cls.__check(topic)
+        with cls.PUBSUB_LOCK:
+            node = cls.__root
+            for level in levels:
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = _TopicNode()
+                node = child
+            node.callbacks = node.callbacks + (callback, )
+            cls.TOPIC_MAP[topic] = node.callbacks
+            cls.__resolved = {}
+
+    @classmethod
+    def unsubscribe(cls, topic, callback):
+        levels = cls.__check(topic)
         with cls.PUBSUB_LOCK:
-            if topic not in cls.TOPIC_MAP:
-                cls.TOPIC_MAP[topic] = [callback]
+            path = [cls.__root]
+            for level in levels:
+                node = path[-1].children.get(level)
+                if node is None:
+                    return
+                path.append(node)
+            node.callbacks = tuple(cb for cb in node.callbacks if cb != callback)
+            if node.callbacks:
+                cls.TOPIC_MAP[topic] = node.callbacks
             else:
-                cls.TOPIC_MAP[topic].append(callback)
+                cls.TOPIC_MAP.pop(topic, None)
+                for index in range(len(levels), 0, -1):  # prune the branch left empty.
+                    node = path[index]
+                    if node.callbacks or node.children:
+                        break
+                    del path[index - 1].children[levels[index - 1]]
+            cls.__resolved = {}
+
+    @classmethod
+    def __match(cls, node, levels, index, rv):
+        rest = node.children.get('#')
+        if rest is not None:
+            rv.extend(rest.callbacks)  # also matches the parent level, 'net/#' gets 'net'.
+        if index == len(levels):
+            rv.extend(node.callbacks)
+            return
+        for key in (levels[index], '+'):
+            child = node.children.get(key)
+            if child is not None:
+                cls.__match(child, levels, index + 1, rv)
+
+    @classmethod
+    def subscribers(cls, topic):
+        """callbacks of every filter matching `topic`, each once, cached until the next (un)subscribe."""
+        callbacks = cls.__resolved.get(topic)
+        if callbacks is None:
+            with cls.PUBSUB_LOCK:
+                matched = []
+                cls.__match(cls.__root, topic.split('/'), 0, matched)
+                callbacks = []
+                for cb in matched:
+                    if cb not in callbacks:
+                        callbacks.append(cb)
+                callbacks = tuple(callbacks)
+                if len(cls.__resolved) >= cls.CACHE_SIZE:
+                    cls.__resolved = {}
+                cls.__resolved[topic] = callbacks
+        return callbacks
+
+    @classmethod
+    def executor(cls):
+        if cls.__executor is None:
+            with cls.PUBSUB_LOCK:
+                if cls.__executor is None:
+                    cls.__executor = ThreadPoolExecutor(cls.MAX_WORKERS, max_queue=cls.MAX_QUEUE, block=False)
+        return cls.__executor
+
+    @staticmethod
+    def __call(callbacks, args, kwargs):
+        for cb in callbacks:
+            try:
+                cb(*args, **kwargs)
+            except Exception as e:
+                usys.print_exception(e)
+
+    @classmethod
+    def publish_sync(cls, topic, *args, **kwargs):
+        cls.__call(cls.subscribers(topic), args, kwargs)
 
     @classmethod
     def publish(cls, topic, *args, **kwargs):
-        with cls.PUBSUB_LOCK:
-            for cb in cls.TOPIC_MAP.get(topic, []):
-                Thread(target=cb, args=args, kwargs=kwargs).start()
+        callbacks = cls.subscribers(topic)
+        if not callbacks:
+            return
+        executor = cls.executor()
+        for index, cb in enumerate(callbacks):
+            try:
+                executor.submit(cb, *args, **kwargs)
+            except RejectedError:
+                cls.__call(callbacks[index:], args, kwargs)  # pool is full, slow the publisher down.
+                return
+
+    @classmethod
+    def publish_ordered(cls, topic, *args, **kwargs):
+        callbacks = cls.subscribers(topic)
+        if not callbacks:
+            return
+        with cls.__ordered_lock:
+            pending = cls.__ordered.get(topic)
+            if pending is not None:
+                pending.append((callbacks, args, kwargs))  # the running drain picks it up.
+                return
+            cls.__ordered[topic] = [(callbacks, args, kwargs)]
+        try:
+            cls.executor().submit(cls.__drain, topic)
+        except RejectedError:
+            cls.__drain(topic)
+
+    @classmethod
+    def __drain(cls, topic):
+        while True:
+            with cls.__ordered_lock:
+                pending = cls.__ordered[topic]
+                if not pending:
+                    del cls.__ordered[topic]
+                    return
+                callbacks, args, kwargs = pending.pop(0)
+            cls.__call(callbacks, args, kwargs)
@@ -0,0 +1,106 @@
+"""
+Run the message stack on a desktop: `compat.install()` before importing it puts CPython equivalents of the
+QuecPython-only modules in place, on the module it does nothing. Used by the host side gateway and benchmark.py.
+"""
+
+import sys
+
+
+def install():
+    """Provide utime/usys/uheapq/ujson/ustruct/urandom/osTimer and the QuecPython `_thread` extras on CPython."""
+    try:
+        import utime
+        return  # on the module, nothing to do.
+    except ImportError:
+        pass
+
+    import time
+    import types
+    import ctypes
+    import heapq
+    import json
+    import struct
+    import random
+    import threading
+    import traceback
+    import _thread
+    import queue
+
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+
+    period = 1 << 30
+
+    def ticks_diff(a, b):
+        return ((a - b + period // 2) % period) - period // 2
+
+    module(
+        'utime',
+        time=time.time,
+        sleep=time.sleep,
+        sleep_ms=lambda ms: time.sleep(ms / 1000),
+        ticks_ms=lambda: int(time.monotonic() * 1000) % period,
+        ticks_us=lambda: int(time.monotonic() * 1000000) % period,
+        ticks_add=lambda a, b: (a + b) % period,
+        ticks_diff=ticks_diff,
+    )
+    module('usys', print_exception=traceback.print_exception, stdout=sys.stdout, stderr=sys.stderr, exit=sys.exit)
+    module('uheapq', heappush=heapq.heappush, heappop=heapq.heappop, heapify=heapq.heapify)
+    module('ujson', dumps=json.dumps, loads=json.loads, dump=json.dump, load=json.load)
+    module('ustruct', pack=struct.pack, unpack=struct.unpack, unpack_from=struct.unpack_from, calcsize=struct.calcsize)
+    module('urandom', random=random.random, getrandbits=random.getrandbits, randint=random.randint,
+           choice=random.choice, seed=random.seed)
+
+    class osTimer(object):
+
+        def __init__(self):
+            self.timer = None
+
+        def start(self, period, mode, callback):
+            self.stop()
+
+            def expire():
+                callback(None)
+                if mode:
+                    self.start(period, mode, callback)
+            self.timer = threading.Timer(period / 1000, expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+        def stop(self):
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    sys.modules['osTimer'] = osTimer
+
+    running = set()
+    running_lock = threading.Lock()
+
+    def start_new_thread(function, args, kwargs=None):
+        done = []
+
+        def target():
+            try:
+                function(*args, **(kwargs or {}))
+            finally:
+                with running_lock:
+                    done.append(True)
+                    running.discard(threading.get_ident())
+        t = threading.Thread(target=target, daemon=True)
+        t.start()
+        with running_lock:
+            if not done:  # short jobs may be over already.
+                running.add(t.ident)
+        return t.ident
+
+    def stop_thread(ident):
+        running.discard(ident)
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident), ctypes.py_object(SystemExit))
+
+    _thread.start_new_thread = start_new_thread
+    _thread.threadIsRunning = lambda ident: ident in running
+    _thread.stop_thread = stop_thread
+    queue.Queue.size = queue.Queue.qsize
@@ -0,0 +1,89 @@
+import utime
+import urandom as random
+from common import Lock
+
+
+class LoopbackStream(object):
+    """In-memory stand-in for `serial.Serial`, one end of a simulated link made by `pair`."""
+
+    def __init__(self, latency=0, bandwidth=0, bit_error_rate=0.0):
+        self.latency = latency  # ms, one way.
+        self.bandwidth = bandwidth  # bytes per second, 0 for unlimited.
+        self.bit_error_rate = bit_error_rate
+        self.peer = None
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.__lock = Lock()
+        self.__pending = []  # [deliver at ticks_us, data], in order of delivery.
+        self.__busy_until = None  # ticks_us the simulated wire is free again.
+
+    def write(self, data):
+        data = bytes(data)
+        self.bytes_written += len(data)
+        busy_until = self.peer.__arrive(data)
+        if self.bandwidth:
+            wait = utime.ticks_diff(busy_until, utime.ticks_us())
+            if wait > 0:
+                utime.sleep_ms((wait + 999) // 1000)  # like a uart, return once the bytes are on the wire.
+
+    def __arrive(self, data):
+        if self.bit_error_rate:
+            data = self.__corrupt(data)
+        now = utime.ticks_us()
+        with self.__lock:
+            start = now
+            if self.__busy_until is not None and utime.ticks_diff(self.__busy_until, now) > 0:
+                start = self.__busy_until  # wait for the bytes already on the wire.
+            duration = len(data) * 1000000 // self.bandwidth if self.bandwidth else 0
+            self.__busy_until = utime.ticks_add(start, duration)
+            deliver = utime.ticks_add(self.__busy_until, int(self.latency * 1000))
+            self.__pending.append([deliver, data])
+            return self.__busy_until
+
+    def __corrupt(self, data):
+        byte_error_rate = 1 - (1 - self.bit_error_rate) ** 8
+        data = bytearray(data)
+        for index in range(len(data)):
+            if random.random() < byte_error_rate:
+                data[index] ^= 1 << random.getrandbits(3)
+        return bytes(data)
+
+    def __take(self, size):
+        now = utime.ticks_us()
+        rv = b''
+        with self.__lock:
+            while self.__pending and len(rv) < size and utime.ticks_diff(now, self.__pending[0][0]) >= 0:
+                deliver, data = self.__pending[0]
+                need = size - len(rv)
+                if len(data) > need:
+                    self.__pending[0][1] = data[need:]
+                    data = data[:need]
+                else:
+                    self.__pending.pop(0)
+                rv += data
+        self.bytes_read += len(rv)
+        return rv
+
+    def read(self, size, timeout=0):
+        """
+        same as `serial.Serial.read`.
+        :param timeout: int(ms). =0 for no blocking, <0 for block forever, >0 for block until timeout.
+        """
+        rv = self.__take(size)
+        if rv or timeout == 0:
+            return rv
+        start = utime.ticks_ms()
+        while True:
+            utime.sleep_ms(1)
+            rv = self.__take(size)
+            if rv:
+                return rv
+            if timeout > 0 and utime.ticks_diff(utime.ticks_ms(), start) >= timeout:
+                return rv
+
+
+def pair(latency=0, bandwidth=0, bit_error_rate=0.0):
+    a = LoopbackStream(latency, bandwidth, bit_error_rate)
+    b = LoopbackStream(latency, bandwidth, bit_error_rate)
+    a.peer, b.peer = b, a
+    return a, b
@@ -1,11 +1,36 @@
+import usys
+import utime
+import uheapq as heapq
 import ujson as json
-from common import Lock, Queue, Thread, Waiter, TimeoutError
+import ustruct as struct
+import urandom as random
+from common import Lock, Queue, Thread, Waiter, TimeoutError, _Result
+from metrics import Metrics
+try:
+    import zlib
+except ImportError:
+    zlib = None  # firmware without zlib, bodies always go out uncompressed.
+# micropython zlib only decompresses and has no preset dictionary, compression is for the host side.
+DEFLATE = zlib is not None and hasattr(zlib, 'compressobj')
+INFLATE = zlib is not None and hasattr(zlib, 'decompressobj')
 
 
 class FormatError(Exception):
     pass
 
 
+class IdentifierError(FormatError):
+    pass
+
+
+class EscapeError(FormatError):
+    pass
+
+
+class DecodeError(FormatError):
+    pass
+
+
 class ValidateError(Exception):
     pass
 
@@ -13,24 +38,52 @@ class ValidateError(Exception):
 class SerialNumber(object):
     max_number = 0xFFFF
     lock = Lock()
-    iterator = iter(range(max_number+1))
+    iterators = {}  # channel -> iterator, every channel counts on its own.
 
     @classmethod
-    def get(cls):
+    def get(cls, channel=0):
         with cls.lock:
-            try:
-                return next(cls.iterator)
-            except StopIteration:
-                cls.iterator = iter(range(cls.max_number+1))
-                return next(cls.iterator)
+            iterator = cls.iterators.get(channel)
+            if iterator is not None:
+                try:
+                    return next(iterator)
+                except StopIteration:
+                    pass
+            iterator = cls.iterators[channel] = iter(range(cls.max_number+1))
+            return next(iterator)
+
+
+def _crc16_table():
+    table = []
+    for one in range(256):
+        crc = one << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+
+CRC16_TABLE = _crc16_table()  # CRC-16/CCITT, poly 0x1021
 
 
 class Head(object):
     LENGTH = 3
 
-    def __init__(self, ack=False, serial_number=None):
+    def __init__(self, ack=False, serial_number=None, codec=0, check=0, fragment=None, channel=0, compress=False,
+                 session=None):
         self.ack = ack
         self.serial_number = serial_number
+        self.codec = codec
+        self.check = check
+        self.compress = compress
+        self.fragment = fragment  # (group serial number, index, count)
+        self.channel = channel
+        self.session = session  # random id of the sender's MessageService.init, None when left out.
+
+    @property
+    def size(self):
+        return self.LENGTH + (1 if self.channel else 0) + (2 if self.session is not None else 0) + \
+            (6 if self.fragment else 0)
 
     def dump(self):
         flag = 0x00
@@ -38,15 +91,60 @@ class Head(object):
             flag |= 0x80
         else:
             flag &= 0x7F
-        return bytearray([flag]) + self.serial_number.to_bytes(2, 'big')
+        if self.codec:
+            flag |= 0x40  # body is not json, old peers leave this bit clear.
+        if self.check:
+            flag |= 0x20  # frame ends with 2 bytes crc16 instead of 1 byte xor.
+        if self.fragment:
+            flag |= 0x10  # group, index and count follow the serial number.
+        if self.compress:
+            flag |= 0x08  # body is raw deflate with Body.DICTIONARY preset.
+        if self.channel:
+            flag |= 0x04  # channel id follows the serial number, channel 0 leaves this bit clear.
+        if self.session is not None:
+            flag |= 0x02  # session id follows the channel id, a new one tells the peer we restarted.
+        raw = bytearray([flag]) + self.serial_number.to_bytes(2, 'big')
+        if self.channel:
+            raw.append(self.channel)
+        if self.session is not None:
+            raw += self.session.to_bytes(2, 'big')
+        if self.fragment:
+            for one in self.fragment:
+                raw += one.to_bytes(2, 'big')
+        return raw
 
     @classmethod
     def load(cls, raw):
         flag = raw[0]
         serial_number = int.from_bytes(raw[1:3], 'big')
+        index = cls.LENGTH
+        size = index + (1 if flag & 0x04 else 0) + (2 if flag & 0x02 else 0) + (6 if flag & 0x10 else 0)
+        if len(raw) < size:
+            raise IdentifierError('head less than {} bytes.'.format(size))
+        channel = 0
+        if flag & 0x04:
+            channel = raw[index]
+            index += 1
+        session = None
+        if flag & 0x02:
+            session = int.from_bytes(raw[index:index + 2], 'big')
+            index += 2
+        fragment = None
+        if flag & 0x10:
+            fragment = (
+                int.from_bytes(raw[index:index + 2], 'big'),
+                int.from_bytes(raw[index + 2:index + 4], 'big'),
+                int.from_bytes(raw[index + 4:index + 6], 'big')
+            )
         self = cls(
             ack=bool(flag & 0x80),
-            serial_number=serial_number
+            serial_number=serial_number,
+            codec=1 if flag & 0x40 else 0,
+            check=1 if flag & 0x20 else 0,
+            fragment=fragment,
+            channel=channel,
+            compress=bool(flag & 0x08),
+            session=session
         )
         return self
 
@@ -54,140 +152,633 @@ class Head(object):
         return self.ack
 
 
+class JsonCodec(object):
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj).encode()
+
+    @staticmethod
+    def loads(raw):
+        return json.loads(raw.decode())
+
+
+class BinaryCodec(object):
+    """msgpack compatible subset: None, bool, int, float, str, list/tuple and dict."""
+
+    @classmethod
+    def dumps(cls, obj):
+        buf = bytearray()
+        cls.pack(obj, buf)
+        return bytes(buf)
+
+    @classmethod
+    def pack(cls, obj, buf):
+        if obj is None:
+            buf.append(0xC0)
+        elif obj is True:
+            buf.append(0xC3)
+        elif obj is False:
+            buf.append(0xC2)
+        elif isinstance(obj, int):
+            cls.pack_int(obj, buf)
+        elif isinstance(obj, float):
+            buf.append(0xCB)
+            buf.extend(struct.pack('>d', obj))
+        elif isinstance(obj, str):
+            raw = obj.encode()
+            cls.pack_size(len(raw), buf, 0xA0, 32, 0xD9, 0xDA, 0xDB)
+            buf.extend(raw)
+        elif isinstance(obj, (list, tuple)):
+            cls.pack_size(len(obj), buf, 0x90, 16, None, 0xDC, 0xDD)
+            for one in obj:
+                cls.pack(one, buf)
+        elif isinstance(obj, dict):
+            cls.pack_size(len(obj), buf, 0x80, 16, None, 0xDE, 0xDF)
+            for key, value in obj.items():
+                cls.pack(key, buf)
+                cls.pack(value, buf)
+        else:
+            raise TypeError('can not pack {} object.'.format(type(obj)))
+
+    @staticmethod
+    def pack_int(obj, buf):
+        if 0 <= obj < 0x80:
+            buf.append(obj)
+        elif -0x20 <= obj < 0:
+            buf.append(obj & 0xFF)
+        elif obj >= 0:
+            if obj <= 0xFF:
+                buf.append(0xCC)
+                buf.extend(struct.pack('>B', obj))
+            elif obj <= 0xFFFF:
+                buf.append(0xCD)
+                buf.extend(struct.pack('>H', obj))
+            elif obj <= 0xFFFFFFFF:
+                buf.append(0xCE)
+                buf.extend(struct.pack('>I', obj))
+            else:
+                buf.append(0xCF)
+                buf.extend(struct.pack('>Q', obj))
+        else:
+            if obj >= -0x80:
+                buf.append(0xD0)
+                buf.extend(struct.pack('>b', obj))
+            elif obj >= -0x8000:
+                buf.append(0xD1)
+                buf.extend(struct.pack('>h', obj))
+            elif obj >= -0x80000000:
+                buf.append(0xD2)
+                buf.extend(struct.pack('>i', obj))
+            else:
+                buf.append(0xD3)
+                buf.extend(struct.pack('>q', obj))
+
+    @staticmethod
+    def pack_size(size, buf, fix, fix_limit, marker8, marker16, marker32):
+        if size < fix_limit:
+            buf.append(fix | size)
+        elif marker8 is not None and size <= 0xFF:
+            buf.append(marker8)
+            buf.append(size)
+        elif size <= 0xFFFF:
+            buf.append(marker16)
+            buf.extend(struct.pack('>H', size))
+        else:
+            buf.append(marker32)
+            buf.extend(struct.pack('>I', size))
+
+    # marker -> (struct format, size)
+    NUMBERS = {
+        0xCA: ('>f', 4), 0xCB: ('>d', 8),
+        0xCC: ('>B', 1), 0xCD: ('>H', 2), 0xCE: ('>I', 4), 0xCF: ('>Q', 8),
+        0xD0: ('>b', 1), 0xD1: ('>h', 2), 0xD2: ('>i', 4), 0xD3: ('>q', 8),
+    }
+
+    @classmethod
+    def loads(cls, raw):
+        try:
+            obj, index = cls.unpack(raw, 0)
+        except FormatError:
+            raise
+        except Exception as e:
+            raise FormatError('binary body broken: {}'.format(e))
+        if index != len(raw):
+            raise FormatError('binary body has {} trailing bytes.'.format(len(raw) - index))
+        return obj
+
+    @classmethod
+    def unpack(cls, raw, index):
+        marker = raw[index]
+        index += 1
+        if marker < 0x80:
+            return marker, index
+        if marker >= 0xE0:
+            return marker - 0x100, index
+        if marker <= 0x8F:
+            return cls.unpack_map(raw, index, marker & 0x0F)
+        if marker <= 0x9F:
+            return cls.unpack_array(raw, index, marker & 0x0F)
+        if marker <= 0xBF:
+            return cls.unpack_str(raw, index, marker & 0x1F)
+        if marker == 0xC0:
+            return None, index
+        if marker == 0xC2:
+            return False, index
+        if marker == 0xC3:
+            return True, index
+        if marker in cls.NUMBERS:
+            fmt, size = cls.NUMBERS[marker]
+            if index + size > len(raw):
+                raise IndexError('number out of range')
+            return struct.unpack_from(fmt, raw, index)[0], index + size
+        if marker == 0xD9:
+            return cls.unpack_str(raw, index + 1, raw[index])
+        if marker in (0xDA, 0xDC, 0xDE):
+            size = struct.unpack_from('>H', raw, index)[0]
+            index += 2
+        elif marker in (0xDB, 0xDD, 0xDF):
+            size = struct.unpack_from('>I', raw, index)[0]
+            index += 4
+        else:
+            raise FormatError('unsupported binary marker 0x{:02X}.'.format(marker))
+        if marker in (0xDA, 0xDB):
+            return cls.unpack_str(raw, index, size)
+        if marker in (0xDC, 0xDD):
+            return cls.unpack_array(raw, index, size)
+        return cls.unpack_map(raw, index, size)
+
+    @staticmethod
+    def unpack_str(raw, index, size):
+        if index + size > len(raw):
+            raise IndexError('string out of range')
+        return bytes(raw[index:index + size]).decode(), index + size
+
+    @classmethod
+    def unpack_array(cls, raw, index, size):
+        rv = []
+        for _ in range(size):
+            one, index = cls.unpack(raw, index)
+            rv.append(one)
+        return rv, index
+
+    @classmethod
+    def unpack_map(cls, raw, index, size):
+        rv = {}
+        for _ in range(size):
+            key, index = cls.unpack(raw, index)
+            rv[key], index = cls.unpack(raw, index)
+        return rv, index
+
+
 class Body(object):
+    JSON = 0
+    BINARY = 1
+    CODECS = {JSON: JsonCodec, BINARY: BinaryCodec}
+    COMPRESS_THRESHOLD = 128  # smaller bodies do not gain from deflate.
+    WBITS = -10  # raw deflate with a 1 KB window, about 12 KB ram to compress.
+    # a wire constant, both ends must use the same dictionary. it holds the keys our devices report, not a sample
+    # payload, the most common strings go last, they are found the nearest. devices can neither deflate nor inflate
+    # (micropython zlib has no compressobj, nor decompressobj with a dictionary), compress only between hosts.
+    DICTIONARY = (
+        b'"fence_ids": "areas": "coordinate": "version": "iccid": "error": "msg": "code": "name": "type": '
+        b'"value": "time": "status": "voltage": "csq": null, false, true, "temp": "battery": "rssi": '
+        b'"speed": "lng": "lat": "data": [{"ts": 17, "imei": "86", {"cmd": "report", '
+    )
 
-    def __init__(self, payload=None):
+    def __init__(self, payload=None, codec=JSON):
         self.payload = payload or {}
+        self.codec = codec
 
     def dump(self):
-        return json.dumps(self.payload).encode()
+        return self.CODECS[self.codec].dumps(self.payload)
 
     @classmethod
-    def load(cls, raw):
-        self = cls(payload=json.loads(raw.decode()))
+    def deflate(cls, raw):
+        if not DEFLATE:
+            return None
+        compressor = zlib.compressobj(6, zlib.DEFLATED, cls.WBITS, 4, zlib.Z_DEFAULT_STRATEGY, cls.DICTIONARY)
+        return compressor.compress(raw) + compressor.flush()
+
+    @classmethod
+    def inflate(cls, raw):
+        if not INFLATE:
+            raise DecodeError('body is compressed, but zlib.decompressobj is not available.')
+        decompressor = zlib.decompressobj(cls.WBITS, cls.DICTIONARY)
+        return decompressor.decompress(raw) + decompressor.flush()
+
+    @classmethod
+    def load(cls, raw, codec=JSON, compressed=False):
+        try:
+            if compressed:
+                raw = cls.inflate(raw)
+            payload = cls.CODECS[codec].loads(raw)
+        except DecodeError:
+            raise
+        except Exception as e:
+            raise DecodeError('body decode error: {}'.format(e))
+        self = cls(payload=payload, codec=codec)
         return self
 
 
 class Message(object):
     IDENTIFIER = 0x7E
+    XOR = 0
+    CRC16 = 1
 
-    def __init__(self, payload=None, ack=False, serial_number=None):
+    def __init__(self, payload=None, ack=False, serial_number=None, codec=Body.JSON, check=XOR, channel=0,
+                 compress=False):
         if ack and serial_number is None:
             raise ValidateError('ack message must explicitly give a serial number.')
-        self.payload = payload or {}
+        self.__payload = payload or {}
+        self.__raw_body = None  # encoded body of a loaded message, decoded on first access.
+        self.__compressed = False  # raw body is deflated.
+        self.__encoded = None  # (body, compressed) from split, used by the next dump.
         self.ack = ack
-        self.serial_number = SerialNumber.get() if serial_number is None else serial_number
+        self.codec = codec
+        self.check = check
+        self.compress = compress  # deflate bodies from Body.COMPRESS_THRESHOLD bytes on.
+        self.fragment = None
+        self.channel = channel
+        self.session = None  # set by MessageService while the peer may not know our session yet.
+        self.serial_number = SerialNumber.get(channel) if serial_number is None else serial_number
+
+    @property
+    def key(self):
+        return (self.channel << 16) | self.serial_number  # serial numbers are only unique within a channel.
+
+    @property
+    def payload(self):
+        if self.__payload is None:
+            self.__payload = Body.load(self.__raw_body, codec=self.codec, compressed=self.__compressed).payload
+            self.__raw_body = None  # payload may be modified from now on.
+        return self.__payload
+
+    @payload.setter
+    def payload(self, payload):
+        self.__payload = payload or {}
+        self.__raw_body = None
+        self.__encoded = None
+
+    @property
+    def raw_body(self):
+        return memoryview(self.__body()[0])
+
+    def __body(self):
+        if self.__raw_body is not None:
+            return self.__raw_body, self.__compressed  # relay as is, no decode and encode again.
+        if self.__encoded is not None:
+            rv, self.__encoded = self.__encoded, None  # once only, the payload may be changed in place later.
+            return rv
+        body = Body(payload=self.__payload, codec=self.codec).dump()
+        if self.compress and len(body) >= Body.COMPRESS_THRESHOLD:
+            packed = Body.deflate(body)
+            if packed is not None and len(packed) < len(body):
+                return packed, True
+        return body, False
+
+    @classmethod
+    def __from_raw_body(cls, head, raw_body):
+        self = cls(
+            ack=head.ack,
+            serial_number=head.serial_number,
+            codec=head.codec,
+            check=head.check,
+            channel=head.channel,
+            compress=head.compress
+        )
+        self.fragment = head.fragment
+        self.session = head.session
+        self.__payload = None
+        self.__raw_body = raw_body
+        self.__compressed = head.compress
+        return self
+
+    def split(self, size, limit=0):
+        """fragments of at most `size` body bytes, ValidateError if the body is over `limit` the peer can join."""
+        body, compressed = self.__body()  # compress the whole body once, fragments carry the flag.
+        count = (len(body) + size - 1) // size
+        if count <= 1:
+            if self.__raw_body is None:
+                self.__encoded = body, compressed  # sent as one frame next, do not encode it twice.
+            return [self]
+        if count > 0xFFFF:
+            raise ValidateError('payload needs {} fragments, more than 65535.'.format(count))
+        if limit and len(body) > limit:
+            raise ValidateError('body of {} bytes is over the reassembly limit of {} bytes.'.format(len(body), limit))
+        fragments = []
+        for index in range(count):
+            head = Head(
+                ack=self.ack,
+                serial_number=SerialNumber.get(self.channel),
+                codec=self.codec,
+                check=self.check,
+                fragment=(self.serial_number, index, count),
+                channel=self.channel,
+                compress=compressed,
+                session=self.session
+            )
+            fragments.append(self.__from_raw_body(head, body[index * size:(index + 1) * size]))
+        return fragments
+
+    @classmethod
+    def join(cls, fragments):
+        first = fragments[0]
+        body = bytearray()
+        for one in fragments:
+            body.extend(one.raw_body)
+        head = Head(
+            ack=first.ack,
+            serial_number=first.fragment[0],
+            codec=first.codec,
+            check=first.check,
+            channel=first.channel,
+            compress=first.compress,
+            session=first.session
+        )
+        return cls.__from_raw_body(head, body)
 
     def __repr__(self):
         s = ''
         s += 'ack: {}\n'.format(self.ack)
         s += 'serial number: {}\n'.format(self.serial_number)
-        s += 'payload: {}\n'.format(self.payload)
+        s += 'codec: {}\n'.format(self.codec)
+        s += 'check: {}\n'.format(self.check)
+        s += 'channel: {}\n'.format(self.channel)
+        if self.fragment:
+            s += 'fragment: {}\n'.format(self.fragment)
+            s += 'body: {} bytes\n'.format(len(self.__body()[0]))
+        else:
+            s += 'payload: {}\n'.format(self.payload)
         return s
 
+    def __head(self, compressed=False):
+        return Head(
+            ack=self.ack,
+            serial_number=self.serial_number,
+            codec=self.codec,
+            check=self.check,
+            fragment=self.fragment,
+            channel=self.channel,
+            compress=compressed,
+            session=self.session
+        ).dump()
+
+    def __check_bytes(self, crc):
+        if self.check == self.CRC16:
+            return crc >> 8, crc & 0xFF
+        return crc,
+
     def dump(self):
-        head = Head(ack=self.ack, serial_number=self.serial_number)
-        body = Body(payload=self.payload)
-        data = head.dump() + body.dump()
-        crc = self.gen_crc(data)
+        body, compressed = self.__body()
+        data = self.__head(compressed) + body
+        if self.check == self.CRC16:
+            crc = self.gen_crc16(data)
+        else:
+            crc = self.gen_crc(data)
         raw = b''
         raw += self.IDENTIFIER.to_bytes(1, 'big')
-        raw += self.escape(data + bytearray([crc]))
+        raw += self.escape(data + bytearray(self.__check_bytes(crc)))
         raw += self.IDENTIFIER.to_bytes(1, 'big')
         return raw
 
+    def dump_into(self, buf, offset=0):
+        body, compressed = self.__body()
+        head = self.__head(compressed)
+        if self.check == self.CRC16:
+            crc = self.gen_crc16(body, self.gen_crc16(head))
+        else:
+            crc = self.gen_crc(body, self.gen_crc(head))
+        end = offset + 2 * (len(head) + len(body) + 2) + 2  # worst case, every byte escaped.
+        if len(buf) < end:
+            buf.extend(bytearray(end - len(buf)))  # grow the caller's buffer once, reuse it later.
+        buf[offset] = self.IDENTIFIER
+        index = self.escape_into(head, buf, offset + 1)
+        index = self.escape_into(body, buf, index)
+        index = self.escape_into(bytes(self.__check_bytes(crc)), buf, index)
+        buf[index] = self.IDENTIFIER
+        return index + 1
+
     @staticmethod
-    def escape(data):
-        origin = b''
-        for one in data:
-            if one == 0x7E:
-                origin += b'\x25\x02'
-            elif one == 0x25:
-                origin += b'\x25\x01'
+    def escape_into(data, buf, index):
+        """escape `data` into `buf` from `index` on, plain runs are copied as slices, returns the index after it."""
+        if not isinstance(data, bytes):
+            data = bytes(data)  # bytearray has no find on the module.
+        view = memoryview(data)
+        src = 0
+        next_7e = data.find(b'\x7E')
+        next_25 = data.find(b'\x25')
+        while next_7e != -1 or next_25 != -1:
+            if next_7e == -1 or (next_25 != -1 and next_25 < next_7e):
+                at = next_25
             else:
-                origin += one.to_bytes(1, 'big')
-        return origin
+                at = next_7e
+            size = at - src
+            buf[index:index + size] = view[src:at]  # copy the plain run in one go.
+            index += size
+            buf[index] = 0x25
+            if at == next_7e:
+                buf[index + 1] = 0x02
+                next_7e = data.find(b'\x7E', at + 1)
+            else:
+                buf[index + 1] = 0x01
+                next_25 = data.find(b'\x25', at + 1)
+            index += 2
+            src = at + 1
+        size = len(data) - src
+        buf[index:index + size] = view[src:]
+        return index + size
+
+    @classmethod
+    def escape(cls, data):
+        if not isinstance(data, bytes):
+            data = bytes(data)  # bytearray has no find/count on the module.
+        extra = data.count(b'\x7E') + data.count(b'\x25')
+        if not extra:
+            return data  # fast path, nothing to escape.
+        origin = bytearray(len(data) + extra)
+        cls.escape_into(data, origin, 0)
+        return bytes(origin)
 
     @staticmethod
     def revert(data):
-        origin = b''
-        index = 0
-        while index <= len(data) - 1:
-            one = data[index]
-            if one == 0x25:
-                if data[index + 1] == 0x01:
-                    origin += b'\x25'
-                elif data[index + 1] == 0x02:
-                    origin += b'\x7E'
-                else:
-                    raise FormatError('revert error at {} bytes, 0x01 or 0x02 should be followed.'.format(index))
-                index += 2
+        if not isinstance(data, bytes):
+            data = bytes(data)  # memoryview and bytearray have no find/count, take the frame in one copy.
+        total = len(data)
+        index = data.find(b'\x25')
+        if index == -1:
+            return bytes(data)  # fast path, nothing to revert.
+
+        origin = bytearray(total - data.count(b'\x25'))
+        src = dst = 0
+        while index != -1:
+            size = index - src
+            origin[dst:dst + size] = data[src:index]
+            dst += size
+            follow = data[index + 1] if index + 1 < total else None
+            if follow == 0x01:
+                origin[dst] = 0x25
+            elif follow == 0x02:
+                origin[dst] = 0x7E
             else:
-                origin += one.to_bytes(1, 'big')
-                index += 1
-        return origin
+                raise EscapeError('revert error at {} bytes, 0x01 or 0x02 should be followed.'.format(index))
+            dst += 1
+            src = index + 2
+            index = data.find(b'\x25', src)
+        origin[dst:] = data[src:]
+        return bytes(origin)
 
     @classmethod
     def load(cls, raw):
-        if len(raw) < 8:
-            raise FormatError('message less than 8 bytes.')
+        if len(raw) < 7:
+            raise IdentifierError('message less than 7 bytes.')
         if raw[0] != cls.IDENTIFIER or raw[-1] != cls.IDENTIFIER:
-            raise FormatError('identifier error, not a valid message.')
+            raise IdentifierError('identifier error, not a valid message.')
         data = cls.revert(raw[1:-1])
-        crc = data[-1]
-        if crc != cls.gen_crc(data[:-1]):
+        if data[0] & 0x20:
+            crc, size = cls.gen_crc16(data), 2
+        else:
+            crc, size = cls.gen_crc(data), 1
+        if crc != 0:  # crc over data and its own check bytes cancels out.
             raise ValidateError('CRC validate FAILED.')
-        head = Head.load(data[:Head.LENGTH])
-        body = Body.load(data[Head.LENGTH:-1])
-        self = cls(
-            payload=body.payload,
-            ack=head.ack,
-            serial_number=head.serial_number
-        )
-        return self
+        head = Head.load(data)
+        return cls.__from_raw_body(head, data[head.size:-size])
+
+    @classmethod
+    def load_from(cls, raw):
+        total = len(raw)
+        if total < 7:
+            raise IdentifierError('message less than 7 bytes.')
+        if raw[0] != cls.IDENTIFIER or raw[total - 1] != cls.IDENTIFIER:
+            raise IdentifierError('identifier error, not a valid message.')
+        flag = raw[1]
+        if flag == 0x25:
+            flag = 0x7E if raw[2] == 0x02 else 0x25  # a broken escape is reported in the loop below.
+        table = CRC16_TABLE if flag & 0x20 else None
+        data = bytearray(total - 2)
+        index = 0
+        crc = 0 if table is None else 0xFFFF
+        src = 1
+        end = total - 1
+        while src < end:
+            one = raw[src]
+            if one == 0x25:
+                follow = raw[src + 1] if src + 1 < end else None
+                if follow == 0x01:
+                    one = 0x25
+                elif follow == 0x02:
+                    one = 0x7E
+                else:
+                    raise EscapeError('revert error at {} bytes, 0x01 or 0x02 should be followed.'.format(src - 1))
+                src += 2
+            else:
+                src += 1
+            data[index] = one
+            if table is None:
+                crc ^= one
+            else:
+                crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ one]
+            index += 1
+        if crc != 0:  # crc over data and its own check bytes cancels out.
+            raise ValidateError('CRC validate FAILED.')
+        head = Head.load(data)
+        return cls.__from_raw_body(head, data[head.size:index - (2 if table else 1)])  # drop head and check bytes.
 
     @staticmethod
-    def gen_crc(data):
-        crc = data[0]
-        for one in data[1:]:
+    def gen_crc(data, crc=0):
+        for one in data:
             crc ^= one
         return crc
 
+    @staticmethod
+    def gen_crc16(data, crc=0xFFFF):
+        table = CRC16_TABLE
+        for one in data:
+            crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ one]
+        return crc
+
 
 class Parser(object):
+    ERROR_KINDS = ('identifier', 'escape', 'crc', 'body')
 
-    def __init__(self, load=True):
-        self.buffer = b''
+    def __init__(self, load=True, decode=False):
+        self.buffer = b''  # bytes, bytearray has no find on the module.
         self.message_list = []
         self.__load = load
+        self.__decode = decode  # decode payload here, so body errors are counted too.
+        self.__scan_index = 0  # bytes after the pending header already scanned for a tail.
+        self.error_counts = {kind: 0 for kind in self.ERROR_KINDS}
+        self.__error_hooks = {}  # kind -> [callback, interval, last called ticks]
+
+    def set_error_hook(self, kind, callback, interval=1000):
+        if kind not in self.error_counts:
+            raise ValueError('unknown error kind "{}".'.format(kind))
+        if callback is None:
+            self.__error_hooks.pop(kind, None)
+        else:
+            self.__error_hooks[kind] = [callback, interval, None]
+
+    def count_error(self, e):
+        """count `e` by kind and call the hook of the kind, also used for body errors found after parse."""
+        if isinstance(e, ValidateError):
+            kind = 'crc'
+        elif isinstance(e, EscapeError):
+            kind = 'escape'
+        elif isinstance(e, DecodeError):
+            kind = 'body'
+        else:
+            kind = 'identifier'
+        self.error_counts[kind] += 1
+        hook = self.__error_hooks.get(kind)
+        if hook is None:
+            return
+        now = utime.ticks_ms()
+        if hook[2] is None or utime.ticks_diff(now, hook[2]) >= hook[1]:
+            hook[2] = now
+            hook[0](kind, self.error_counts[kind], str(e))
 
     def parse(self, data):
-        self.buffer += data
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        buffer = self.buffer + data if self.buffer else data
 
+        start_index = 0
+        scan_index = self.__scan_index
         while True:
-            header_index = self.buffer.find(b'\x7E')
+            header_index = buffer.find(b'\x7E', start_index)
             if header_index == -1:
-                self.clear()
+                start_index = scan_index = len(buffer)
                 break
 
-            tail_index = self.buffer.find(b'\x7E', header_index+1)
+            tail_index = buffer.find(b'\x7E', max(header_index + 1, scan_index))
             if tail_index == -1:
+                start_index = header_index
+                scan_index = len(buffer)
                 break  # waiting for more bytes
 
             if tail_index - header_index == 1:
-                self.buffer = self.buffer[tail_index:]
+                start_index = tail_index
                 continue
 
+            frame = memoryview(buffer)[header_index:tail_index+1]
             try:
                 if self.__load:
-                    msg = Message.load(self.buffer[header_index:tail_index+1])
+                    msg = Message.load_from(frame)
+                    if self.__decode:
+                        msg.payload
                 else:
-                    msg = self.buffer[header_index:tail_index+1]
-                self.message_list.append(msg)
-            except Exception as e:
-                print('message parse error: {}'.format(e))
+                    msg = bytes(frame)
+            except (FormatError, ValidateError) as e:
+                self.count_error(e)
+                # resync: the closing 0x7E may be the header of the next frame if
+                # this one lost its tail, so scan on from it instead of past it.
+                start_index = tail_index
+                continue
+            self.message_list.append(msg)
+            start_index = tail_index + 1
 
-            self.buffer = self.buffer[tail_index+1:]
+        self.buffer = buffer[start_index:] if start_index else buffer  # compact once per call, not once per frame.
+        self.__scan_index = max(scan_index - start_index, 0)
 
     @property
     def messages(self):
@@ -196,72 +787,700 @@ class Parser(object):
 
     def clear(self):
         self.buffer = b''
+        self.__scan_index = 0
+
+    def reset_error_counts(self):
+        for kind in self.error_counts:
+            self.error_counts[kind] = 0
+
+
+class ReceiveQueue(object):
+    DROP_OLDEST = 0
+    DROP_NEWEST = 1
+    BLOCK = 2
+
+    def __init__(self, maxsize=64, policy=DROP_OLDEST, lanes=1, priority=None):
+        if maxsize <= 0 or lanes <= 0:
+            raise ValueError('maxsize and lanes must be greater than 0.')
+        if policy not in (self.DROP_OLDEST, self.DROP_NEWEST, self.BLOCK):
+            raise ValueError('unknown overflow policy {}.'.format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.priority = priority  # msg -> lane, 0 is served first.
+        self.lanes = [[] for _ in range(lanes)]
+        self.lock = Lock()
+        self.tokens = Queue(maxsize)  # one token per queued message, get blocks on it.
+        self.room = Queue(maxsize) if policy == self.BLOCK else None  # the same, put blocks on it while full.
+        self.count = 0
+        self.high_watermark = 0
+        self.drop_count = 0
+
+    def __lane_of(self, msg):
+        if self.priority is None:
+            return 0
+        return min(max(self.priority(msg), 0), len(self.lanes) - 1)
+
+    def put(self, msg):
+        lane = self.__lane_of(msg)
+        if self.room is not None:
+            self.room.put(None)  # with BLOCK policy, the reader waits here while full.
+        with self.lock:
+            if self.count >= self.maxsize and self.policy != self.BLOCK:
+                self.drop_count += 1
+                if self.policy == self.DROP_NEWEST:
+                    return False
+                for one in range(len(self.lanes) - 1, lane - 1, -1):
+                    if self.lanes[one]:
+                        self.lanes[one].pop(0)  # oldest of the least important lane goes first.
+                        self.lanes[lane].append(msg)
+                        return True
+                return False  # everything queued is more important than msg.
+            self.lanes[lane].append(msg)
+            self.count += 1
+            self.high_watermark = max(self.high_watermark, self.count)
+        self.tokens.put(None)
+        return True
+
+    def get(self):
+        self.tokens.get()
+        with self.lock:
+            self.count -= 1
+            for lane in self.lanes:
+                if lane:
+                    msg = lane.pop(0)
+                    break
+        if self.room is not None:
+            self.room.get()
+        return msg
+
+    def size(self):
+        return self.count
+
+    def empty(self):
+        return self.count == 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.count,
+                'lanes': [len(lane) for lane in self.lanes],
+                'high_watermark': self.high_watermark,
+                'dropped': self.drop_count,
+            }
+
+
+class Dispatcher(object):
+
+    def __init__(self, key='cmd', workers=2, depth=32):
+        if workers <= 0:
+            raise ValueError('workers must be greater than 0.')
+        self.key = key
+        self.handlers = {}  # payload[key] value -> handler
+        self.lanes = [Queue(depth) for _ in range(workers)]  # one key always goes to one lane, keeps its order.
+        self.threads = [Thread(target=self.__worker, args=(lane, )) for lane in self.lanes]
+        self.lock = Lock()
+        self.reply = None
+        self.dispatched_count = 0
+        self.error_count = 0
+        self.high_watermark = 0
+
+    def register(self, value, handler):
+        self.handlers[value] = handler
+
+    def unregister(self, value):
+        self.handlers.pop(value, None)
+
+    def start(self, reply):
+        self.reply = reply
+        for t in self.threads:
+            t.start()
+
+    def stop(self):
+        for t in self.threads:
+            t.stop()
+
+    def dispatch(self, msg):
+        if not self.handlers:
+            return False
+        payload = msg.payload
+        if not isinstance(payload, dict):
+            return False
+        value = payload.get(self.key)
+        handler = self.handlers.get(value)
+        if handler is None:
+            return False
+        lane = self.lanes[hash(value) % len(self.lanes)]
+        lane.put((handler, msg))  # blocks the reader while this lane is full.
+        with self.lock:
+            self.dispatched_count += 1
+            self.high_watermark = max(self.high_watermark, lane.size())
+        return True
+
+    def __worker(self, lane):
+        while True:
+            handler, msg = lane.get()
+            try:
+                rv = handler(msg)
+                if rv is not None:
+                    self.reply(Message(
+                        rv, ack=True, serial_number=msg.serial_number, codec=msg.codec, channel=msg.channel,
+                        compress=msg.compress
+                    ))
+            except Exception as e:
+                with self.lock:
+                    self.error_count += 1
+                usys.print_exception(e)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': [lane.size() for lane in self.lanes],
+                'high_watermark': self.high_watermark,
+                'dispatched': self.dispatched_count,
+                'errors': self.error_count,
+            }
+
+
+class SerialWindow(object):
+    """serial numbers seen lately, one bit each for the `size` numbers up to the highest, wraps around after 0xFFFF."""
+
+    def __init__(self, size=256):
+        if size <= 0 or size & (size - 1) or size < 8 or size > (SerialNumber.max_number + 1) // 2:
+            raise ValueError('size must be a power of 2 in [8, {}].'.format((SerialNumber.max_number + 1) // 2))
+        self.size = size
+        self.bits = bytearray(size // 8)
+        self.top = None
+
+    def reset(self):
+        for index in range(len(self.bits)):
+            self.bits[index] = 0
+        self.top = None
+
+    def check(self, serial_number):
+        """mark `serial_number` seen, False if it was seen already."""
+        bits = self.bits
+        mask = self.size - 1
+        half = (SerialNumber.max_number + 1) // 2
+        index = serial_number & mask
+        if self.top is not None:
+            ahead = (serial_number - self.top) & SerialNumber.max_number
+            if ahead and ahead < half and ahead < self.size:
+                for one in range(self.top + 1, self.top + ahead + 1):
+                    one &= mask
+                    bits[one >> 3] &= ~(1 << (one & 7))  # forget what the window slides over.
+                self.top = serial_number
+            elif ahead and (ahead < half or (self.top - serial_number) & SerialNumber.max_number >= self.size):
+                self.reset()  # too far from the window to tell, most likely the peer restarted.
+                self.top = serial_number
+            elif bits[index >> 3] & (1 << (index & 7)):
+                return False
+        else:
+            self.top = serial_number
+        bits[index >> 3] |= 1 << (index & 7)
+        return True
+
+    def forget(self, serial_number):
+        """unmark `serial_number`, it was refused and comes again."""
+        if self.top is not None and (self.top - serial_number) & SerialNumber.max_number < self.size:
+            index = serial_number & (self.size - 1)
+            self.bits[index >> 3] &= ~(1 << (index & 7))
+
+
+class Channel(object):
+    DUPLICATE_WINDOW = 256  # serial numbers remembered to drop retransmitted messages.
+    ACK_CACHE = 16  # acks kept to answer those retransmissions again.
+
+    def __init__(self, channel_id, weight=1, window=8, queue=None):
+        if not 0 <= channel_id <= 0xFF:
+            raise ValueError('channel id must be in [0, 255].')
+        if weight <= 0:
+            raise ValueError('weight must be greater than 0.')
+        if not 0 < window <= (SerialNumber.max_number + 1) // 2:
+            raise ValueError('window must be in (0, {}].'.format((SerialNumber.max_number + 1) // 2))
+        self.id = channel_id
+        self.weight = weight
+        self.queue = ReceiveQueue() if queue is None else queue
+        self.window_tokens = Queue(window)
+        for _ in range(window):
+            self.window_tokens.put(None)
+        self.outbox = []  # (frame size, turn) of writers waiting for the link.
+        self.deficit = 0
+        self.seen = SerialWindow(self.DUPLICATE_WINDOW)
+        self.acks = {}  # serial number -> ack sent for it
+        self.ack_ring = [None] * self.ACK_CACHE  # (serial number, ack), the oldest is replaced.
+        self.ack_index = 0
+        self.announce = True  # send our session id until the peer acks something on this channel.
+        self.peer_session = None
+
+    def restart_peer(self, session):
+        """the peer counts its serial numbers from 0 again, forget what it sent before."""
+        self.peer_session = session
+        self.seen.reset()
+        self.acks.clear()
+        self.ack_ring = [None] * self.ACK_CACHE
+        self.ack_index = 0
+
+    def cache_ack(self, ack):
+        old = self.ack_ring[self.ack_index]
+        if old is not None and self.acks.get(old[0]) is old[1]:
+            del self.acks[old[0]]
+        self.ack_ring[self.ack_index] = (ack.serial_number, ack)
+        self.ack_index = (self.ack_index + 1) % len(self.ack_ring)
+        self.acks[ack.serial_number] = ack
+
+
+class _FairQueue(object):
+    """deficit round robin, a channel may write `weight * quantum` bytes per round."""
+
+    def __init__(self, quantum=256):
+        self.quantum = quantum
+        self.active = []  # channels with writers waiting, the head is served.
+
+    def push(self, channel, frame, turn):
+        if not channel.outbox:
+            channel.deficit = 0 if self.active else self.quantum * channel.weight
+            self.active.append(channel)
+        channel.outbox.append((len(frame), turn))
+
+    def pop(self):
+        active = self.active
+        while active:
+            channel = active[0]
+            size, turn = channel.outbox[0]
+            if size <= channel.deficit:
+                channel.outbox.pop(0)
+                channel.deficit -= size
+                if not channel.outbox:
+                    active.pop(0)  # an idle channel keeps no credit.
+                    self.__next_turn()
+                return turn
+            active.append(active.pop(0))  # turn is over, the credit left carries to its next round.
+            self.__next_turn()
+
+    def __next_turn(self):
+        if self.active:
+            head = self.active[0]
+            head.deficit += self.quantum * head.weight
+
+
+class _InFlight(object):
+
+    def __init__(self, channel, frame, timeout, retries, backoff):
+        self.channel = channel
+        self.frame = frame
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.attempts = 0
+        self.sent = utime.ticks_ms()
+        self.deadline = utime.ticks_add(self.sent, int(timeout * 1000))
+        self.result = _Result()
+
+    def next_deadline(self, now):
+        self.attempts += 1
+        delay = self.timeout * (self.backoff ** self.attempts)
+        self.deadline = utime.ticks_add(now, int(delay * 1000))
+        return self.deadline
 
 
 class MessageService(object):
 
-    def __init__(self):
+    def __init__(self, window=8, fragment_size=0, fragment_timeout=1, reassembly_limit=8192, reassembly_timeout=30,
+                 announce_session=False):
         self.stream = None
-        self.queue = Queue()
+        self.channels = {}  # channel id -> Channel
+        self.unknown_channel_count = 0
+        self.parser = Parser()
+        self.dispatcher = Dispatcher()
+        self.read_error_count = 0
         self.read_thread = Thread(target=self.__read_thread_worker)
+        self.capture = None  # capture.CaptureWriter, records every raw read.
         self.ack_lock = Lock()
-        self.ack_dict = {}
+        self.ack_dict = {}  # message key -> [response, waiter, deadline, sent ticks]
+        self.ack_deadlines = []  # heap of (deadline, message key)
+        self.stale_ack_count = 0
+        self.duplicate_ack_count = 0
+        self.duplicate_message_count = 0
+        self.announce_session = announce_session  # only for peers that read head flag 0x02, older ones cannot.
+        self.session = None  # random per init, see Channel.announce.
+        self.peer_restart_count = 0
+        self.write_lock = Lock()
+        self.write_buffer = bytearray()
+        self.writing = False  # some thread owns the link, others wait for their turn in the scheduler.
+        self.scheduler = _FairQueue()
+        self.window_dict = {}  # message key -> _InFlight
+        self.window_deadlines = []  # heap of (deadline, message key)
+        self.fragment_size = fragment_size  # 0 sends every body in one frame, peers before fragmentation need that.
+        self.fragment_timeout = fragment_timeout  # ack timeout of a single fragment, retransmit after it.
+        self.reassembly_limit = reassembly_limit  # bytes buffered for all unfinished groups, same on both ends.
+        self.reassembly_timeout = reassembly_timeout
+        self.reassembly_size = 0
+        self.reassembly_dict = {}  # group key -> [count, {index: fragment}, size, last ticks]
+        self.reassembly_drop_count = 0
+        self.open_channel(0, window=window)
+        self.metrics = Metrics()
+        self.bytes_in = self.metrics.counter('bytes_in')
+        self.bytes_out = self.metrics.counter('bytes_out')
+        self.frames_in = self.metrics.counter('frames_in')
+        self.frames_out = self.metrics.counter('frames_out')
+        self.ack_timeouts = self.metrics.counter('ack_timeouts')
+        self.retransmits = self.metrics.counter('retransmits')
+        self.post_failures = self.metrics.counter('post_failures')
+        self.ack_rtt = self.metrics.histogram('ack_rtt_ms')
+        for name, probe in (
+            ('queue_depth', lambda: sum(one.queue.size() for one in self.channels.values())),
+            ('queue_high_watermark', lambda: max(one.queue.high_watermark for one in self.channels.values())),
+            ('queue_dropped', lambda: sum(one.queue.drop_count for one in self.channels.values())),
+            ('ack_waiters', lambda: len(self.ack_dict)),
+            ('in_flight', lambda: len(self.window_dict)),
+            ('reassembly_bytes', lambda: self.reassembly_size),
+            ('reassembly_drops', lambda: self.reassembly_drop_count),
+            ('stale_acks', lambda: self.stale_ack_count),
+            ('duplicate_acks', lambda: self.duplicate_ack_count),
+            ('duplicate_messages', lambda: self.duplicate_message_count),
+            ('peer_restarts', lambda: self.peer_restart_count),
+            ('unknown_channel', lambda: self.unknown_channel_count),
+            ('read_errors', lambda: self.read_error_count),
+            ('parser_errors', lambda: dict(self.parser.error_counts)),
+        ):
+            self.metrics.gauge(name, probe)
+
+    @property
+    def queue(self):
+        return self.channels[0].queue
+
+    @queue.setter
+    def queue(self, queue):
+        self.channels[0].queue = queue
+
+    def open_channel(self, channel_id, weight=1, window=8, queue=None):
+        """
+        the peer must open the same channel id, messages for a channel not open here are dropped.
+        :param weight: share of the link while channels compete, control channels get a higher weight than bulk.
+        """
+        if channel_id in self.channels:
+            raise ValueError('channel {} is already open.'.format(channel_id))
+        channel = self.channels[channel_id] = Channel(channel_id, weight, window, queue)
+        return channel
+
+    def __channel(self, channel_id):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            raise ValueError('channel {} is not open.'.format(channel_id))
+        return channel
 
     def init(self, stream):
         self.stream = stream
+        self.session = random.getrandbits(16) if self.announce_session else None
+        for channel in self.channels.values():
+            channel.restart_peer(None)  # a new peer counts from anywhere.
+            channel.announce = True
+        self.dispatcher.start(lambda msg: self.send(msg, timeout=0))
         self.read_thread.start()
 
     def deinit(self):
         self.read_thread.stop()
+        self.dispatcher.stop()
         self.stream = None
 
-    def get_ack(self, request, timeout=-1):
-        waiter = Waiter()
-        with self.ack_lock:
-            self.ack_dict[request] = [None, waiter]
+    def __is_duplicate(self, msg):
+        channel = self.channels.get(msg.channel)
+        if channel is None:
+            return False
+        if msg.session is not None and msg.session != channel.peer_session:
+            if channel.peer_session is not None:
+                self.peer_restart_count += 1
+            channel.restart_peer(msg.session)  # old serial numbers and acks belong to the session before.
+            self.__drop_groups(msg.channel)
+        if channel.seen.check(msg.serial_number):
+            return False
+        self.duplicate_message_count += 1  # retransmitted, the peer missed our ack.
+        if msg.fragment:
+            self.__write(Message(ack=True, serial_number=msg.serial_number, channel=msg.channel))
+        else:
+            ack = channel.acks.get(msg.serial_number)
+            if ack is not None:  # not acked yet otherwise, the ack goes out when it is.
+                # written as it is, post would wait here for window acks only this thread reads.
+                for one in ack.split(self.fragment_size) if self.fragment_size else [ack]:
+                    self.__write(one)
+        return True
 
-        try:
-            waiter.acquire(timeout)
-        except TimeoutError as e:
-            with self.ack_lock:
-                del self.ack_dict[request]
+    def __deliver(self, msg):
+        channel = self.channels.get(msg.channel)
+        if channel is None:
+            self.unknown_channel_count += 1
             return
-        else:
-            with self.ack_lock:
-                response = self.ack_dict[request][0]
-                del self.ack_dict[request]
-            return response
+        if not self.dispatcher.dispatch(msg):
+            channel.queue.put(msg)
+
+    def __add_ack_waiter(self, key, timeout=-1):
+        entry = [None, Waiter(), None, utime.ticks_ms()]  # [response, waiter, deadline, sent ticks]
+        if timeout > 0:
+            entry[2] = utime.ticks_add(entry[3], int(timeout * 1000))
+        with self.ack_lock:
+            self.ack_dict[key] = entry
+            if entry[2] is not None:
+                heapq.heappush(self.ack_deadlines, (entry[2], key))
+        return entry
+
+    def __wait_ack(self, key, entry, timeout=-1):
+        if entry[0] is None:
+            entry[1].acquire(timeout)
+        with self.ack_lock:
+            if self.ack_dict.get(key) is entry:
+                del self.ack_dict[key]
+        if entry[0] is None:
+            self.ack_timeouts.add()
+        return entry[0]
+
+    def get_ack(self, request, timeout=-1):
+        entry = self.__add_ack_waiter(request.key, timeout)
+        return self.__wait_ack(request.key, entry, timeout)
 
     def put_ack(self, response):
         with self.ack_lock:
-            for request, temp in self.ack_dict.items():
-                if request.serial_number == response.serial_number:
-                    temp[0] = response
-                    temp[1].release()
-                    break
+            flight = self.window_dict.pop(response.key, None)
+            if flight is None:
+                entry = self.ack_dict.get(response.key)
+                if entry is None:
+                    self.stale_ack_count += 1  # timed out, or never requested.
+                    return False
+                if entry[0] is not None:
+                    self.duplicate_ack_count += 1
+                    return False
+                entry[0] = response
+        channel = self.channels.get(response.channel)
+        if channel is not None:
+            channel.announce = False  # the peer has seen our session.
+        now = utime.ticks_ms()
+        if flight is not None:
+            if not flight.attempts:
+                self.ack_rtt.add(utime.ticks_diff(now, flight.sent))  # after a retransmit either copy may be acked.
+            flight.result.set(None, response)
+            flight.channel.window_tokens.put(None)
+        else:
+            self.ack_rtt.add(utime.ticks_diff(now, entry[3]))
+            entry[1].release()
+        return True
+
+    def __expire_acks(self):
+        expired = []
+        now = utime.ticks_ms()
+        with self.ack_lock:
+            while self.ack_deadlines and utime.ticks_diff(self.ack_deadlines[0][0], now) <= 0:
+                deadline, key = heapq.heappop(self.ack_deadlines)
+                entry = self.ack_dict.get(key)
+                if entry is not None and entry[2] == deadline:
+                    del self.ack_dict[key]
+                    expired.append(entry)
+        for entry in expired:
+            entry[1].release()
+
+    def __retransmit(self):
+        resend = []
+        failed = []
+        now = utime.ticks_ms()
+        with self.ack_lock:
+            while self.window_deadlines and utime.ticks_diff(self.window_deadlines[0][0], now) <= 0:
+                deadline, key = heapq.heappop(self.window_deadlines)
+                flight = self.window_dict.get(key)
+                if flight is None or flight.deadline != deadline:
+                    continue  # acked already.
+                if flight.attempts >= flight.retries:
+                    del self.window_dict[key]
+                    failed.append(flight)
+                else:
+                    heapq.heappush(self.window_deadlines, (flight.next_deadline(now), key))
+                    resend.append(flight)
+        self.retransmits.add(len(resend))
+        self.post_failures.add(len(failed))
+        for flight in failed:
+            flight.result.set(TimeoutError('no ack after {} attempts.'.format(flight.attempts + 1)), None)
+            flight.channel.window_tokens.put(None)
+        for flight in resend:
+            self.__transmit(flight.channel, frame=flight.frame)  # may raise, the failed ones are released already.
 
     def __read_thread_worker(self):
-        parser = Parser()
+        parser = self.parser
         while True:
+            try:
+                self.__expire_acks()
+                self.__retransmit()
+                self.__expire_reassembly()
+            except Exception:
+                self.read_error_count += 1  # a failed write while retransmitting, the loop keeps reading.
             try:
                 data = self.stream.read(1024, timeout=10)
+                if data:
+                    self.bytes_in.add(len(data))
+                    if self.capture is not None:
+                        self.capture.write(data)
                 parser.parse(data)
-                for msg in parser.messages:
-                    if msg.ack:
-                        self.put_ack(msg)
-                    else:
-                        self.queue.put(msg)
+                messages = parser.messages
+                self.frames_in.add(len(messages))
+                for msg in messages:
+                    try:
+                        self.__handle(msg)
+                    except DecodeError as e:
+                        parser.count_error(e)  # only this frame, the others of the read still go on.
+                    except Exception:
+                        self.read_error_count += 1
             except TimeoutError:
                 parser.clear()
                 continue
-            except Exception as e:
-                print(e)
+            except Exception:
+                self.read_error_count += 1
                 continue
 
+    def __handle(self, msg):
+        if (msg.fragment or not msg.ack) and self.__is_duplicate(msg):
+            return
+        if msg.fragment:
+            self.__reassemble(msg)
+        elif msg.ack:
+            self.put_ack(msg)
+        else:
+            self.__deliver(msg)
+
+    def __write(self, msg):
+        self.__transmit(self.__channel(msg.channel), msg=msg)
+
+    def __transmit(self, channel, msg=None, frame=None):
+        # the link is handed from writer to writer in weighted fair order, every thread
+        # writes its own frame, nobody is held up writing the frames of another channel.
+        turn = None
+        while True:
+            with self.write_lock:
+                if not self.writing:
+                    self.writing = True
+                    break
+                if frame is not None:
+                    turn = Lock()
+                    turn.acquire()
+                    self.scheduler.push(channel, frame, turn)
+                    break
+            frame = msg.dump()  # link is busy, the scheduler needs the frame size.
+        if turn is not None:
+            turn.acquire()  # released by the writer before us.
+        try:
+            if frame is None:
+                size = msg.dump_into(self.write_buffer)
+                frame = memoryview(self.write_buffer)[:size]
+            self.stream.write(frame)
+            self.bytes_out.add(len(frame))
+            self.frames_out.add()
+        finally:
+            with self.write_lock:
+                turn = self.scheduler.pop()
+                if turn is None:
+                    self.writing = False
+            if turn is not None:
+                turn.release()
+
+    def __reassemble(self, fragment):
+        if fragment.channel not in self.channels:
+            self.unknown_channel_count += 1
+            return
+        # a fragment is acked once it is stored, the sender retransmits the ones refused here.
+        ack = Message(ack=True, serial_number=fragment.serial_number, channel=fragment.channel)
+        group, index, count = fragment.fragment
+        group = (fragment.channel << 16) | group
+        body = fragment.raw_body
+        group_entry = self.reassembly_dict.get(group)
+        if group_entry is not None and index in group_entry[1]:
+            self.__write(ack)  # retransmitted, our ack was lost.
+            return
+        if self.reassembly_size + len(body) > self.reassembly_limit:
+            # stored fragments are acked already, they stay until reassembly_timeout, refuse this one instead.
+            self.channels[fragment.channel].seen.forget(fragment.serial_number)  # not a duplicate when it comes again.
+            self.reassembly_drop_count += 1
+            return
+        if group_entry is None:
+            group_entry = self.reassembly_dict[group] = [count, {}, 0, None]
+        group_entry[1][index] = fragment
+        group_entry[2] += len(body)
+        group_entry[3] = utime.ticks_ms()
+        self.reassembly_size += len(body)
+        self.__write(ack)
+        if len(group_entry[1]) == group_entry[0]:
+            parts = group_entry[1]
+            del self.reassembly_dict[group]
+            self.reassembly_size -= group_entry[2]
+            msg = Message.join([parts[one] for one in range(group_entry[0])])
+            if msg.ack:
+                self.put_ack(msg)
+            else:
+                self.__deliver(msg)
+
+    def __drop_groups(self, channel_id):
+        for group in [one for one in self.reassembly_dict if one >> 16 == channel_id]:
+            self.__drop_group(group)
+
+    def __drop_group(self, group):
+        group_entry = self.reassembly_dict.pop(group)
+        self.reassembly_size -= group_entry[2]
+        self.reassembly_drop_count += 1
+
+    def __expire_reassembly(self):
+        if not self.reassembly_dict:
+            return
+        now = utime.ticks_ms()
+        for group in list(self.reassembly_dict):
+            last = self.reassembly_dict[group][3]
+            if last is not None and utime.ticks_diff(now, last) > self.reassembly_timeout * 1000:
+                self.__drop_group(group)
+
+    def __send_fragments(self, msg, fragments, timeout=-1, retries=3):
+        if timeout == 0:
+            for fragment in fragments:
+                self.post(fragment, timeout=self.fragment_timeout, retries=retries)
+            return
+        entry = self.__add_ack_waiter(msg.key)  # timeout starts after the last fragment.
+        results = [self.post(fragment, timeout=self.fragment_timeout, retries=retries) for fragment in fragments]
+        try:
+            for result in results:
+                result.get()  # raise if a fragment is still missing after retries.
+        except TimeoutError:
+            with self.ack_lock:
+                if self.ack_dict.get(msg.key) is entry:
+                    del self.ack_dict[msg.key]
+            self.ack_timeouts.add()
+            return
+        return self.__wait_ack(msg.key, entry, timeout)
+
+    def __announce(self, msg):
+        channel = self.__channel(msg.channel)
+        msg.session = self.session if channel.announce else None
+        return channel
+
     def send(self, msg, timeout=-1):
-        self.stream.write(msg.dump())
+        channel = self.__announce(msg)
+        if msg.ack:
+            channel.cache_ack(msg)
+        fragments = msg.split(self.fragment_size, self.reassembly_limit) if self.fragment_size else [msg]
+        if len(fragments) > 1:
+            return self.__send_fragments(msg, fragments, timeout)
+        entry = None
         if timeout != 0:
-            return self.get_ack(msg, timeout)
+            entry = self.__add_ack_waiter(msg.key, timeout)  # before writing, the ack may be fast.
+        self.__write(msg)
+        if entry is not None:
+            return self.__wait_ack(msg.key, entry, timeout)
+
+    def post(self, msg, timeout=5, retries=3, backoff=2):
+        channel = self.__announce(msg)
+        channel.window_tokens.get()  # block here while the window of this channel is full.
+        flight = _InFlight(channel, msg.dump(), timeout, retries, backoff)
+        with self.ack_lock:
+            in_flight = msg.key in self.window_dict or msg.key in self.ack_dict
+            if not in_flight:
+                self.window_dict[msg.key] = flight
+                heapq.heappush(self.window_deadlines, (flight.deadline, msg.key))
+        if in_flight:
+            channel.window_tokens.put(None)
+            raise ValidateError('serial number {} is still waiting for ack.'.format(msg.serial_number))
+        self.__transmit(channel, frame=flight.frame)
+        return flight.result
 
-    def recv(self):
-        return self.queue.get()
+    def recv(self, channel_id=0):
+        return self.__channel(channel_id).queue.get()
@@ -0,0 +1,110 @@
+import utime
+
+LATENCY_BOUNDS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)  # ms
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, n=1):
+        self.value += n
+
+    def reset(self):
+        self.value = 0
+
+
+class Histogram(object):
+    """fixed buckets, `bounds` are the ascending upper bounds, one more bucket counts what is above the last."""
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        index = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """upper bound of the bucket holding the `p`th percentile, max for the last bucket."""
+        if not self.count:
+            return 0
+        rank = self.count * p / 100
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= rank and count:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': list(zip(self.bounds + ('inf', ), self.counts)),
+        }
+
+    def reset(self):
+        for index in range(len(self.counts)):
+            self.counts[index] = 0
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+
+class Metrics(object):
+    """counters and histograms are updated in place, gauges are probes only called on snapshot."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.start = utime.ticks_ms()
+
+    def counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = Counter()
+        return counter
+
+    def histogram(self, name, bounds=LATENCY_BOUNDS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(bounds)
+        return histogram
+
+    def gauge(self, name, probe):
+        self.gauges[name] = probe
+
+    def snapshot(self):
+        elapsed = utime.ticks_diff(utime.ticks_ms(), self.start)
+        seconds = elapsed / 1000 if elapsed > 0 else 1
+        return {
+            'elapsed_ms': elapsed,
+            'counters': {name: counter.value for name, counter in self.counters.items()},
+            'rates': {name: counter.value / seconds for name, counter in self.counters.items()},  # per second
+            'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            'gauges': {name: probe() for name, probe in self.gauges.items()},
+        }
+
+    def reset(self):
+        for counter in self.counters.values():
+            counter.reset()
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.start = utime.ticks_ms()
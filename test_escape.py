@@ -0,0 +1,80 @@
+"""
+Regression test for Message.escape/revert and dump_into: the rewritten escaping against the old byte by byte
+code, on random data dense in 0x7E and 0x25. Run `python3 -m unittest test_escape` on a desktop.
+"""
+
+import unittest
+import compat
+
+compat.install()
+
+import urandom as random  # noqa: E402
+from message import Message  # noqa: E402
+
+
+def old_escape(data):
+    """Message.escape before the rewrite."""
+    origin = b''
+    for one in data:
+        if one == 0x7E:
+            origin += b'\x25\x02'
+        elif one == 0x25:
+            origin += b'\x25\x01'
+        else:
+            origin += one.to_bytes(1, 'big')
+    return origin
+
+
+def old_revert(data):
+    """Message.revert before the rewrite."""
+    origin = b''
+    index = 0
+    while index <= len(data) - 1:
+        one = data[index]
+        if one == 0x25:
+            if data[index + 1] == 0x01:
+                origin += b'\x25'
+            elif data[index + 1] == 0x02:
+                origin += b'\x7E'
+            else:
+                raise ValueError('revert error at {} bytes.'.format(index))
+            index += 2
+        else:
+            origin += one.to_bytes(1, 'big')
+            index += 1
+    return origin
+
+
+def random_data(size):
+    return bytes(random.choice((0x7E, 0x25, 0x01, 0x02, random.getrandbits(8))) for _ in range(size))
+
+
+class EscapeTest(unittest.TestCase):
+
+    COUNT = 500
+
+    def test_escape_revert(self):
+        for _ in range(self.COUNT):
+            data = random_data(random.randint(0, 64))
+            escaped = old_escape(data)
+            for kind in (bytes, bytearray):
+                self.assertEqual(Message.escape(kind(data)), escaped, data)
+                self.assertEqual(Message.revert(kind(escaped)), data, data)
+            self.assertEqual(Message.revert(memoryview(escaped)), data, data)
+            self.assertEqual(old_revert(escaped), data, data)
+
+    def test_frames(self):
+        for _ in range(self.COUNT):
+            data = random_data(random.randint(0, 64))
+            msg = Message({'s': data.decode('latin-1')}, serial_number=random.getrandbits(16),
+                          check=random.getrandbits(1))
+            frame = msg.dump()
+            self.assertEqual(Message.escape(old_revert(frame[1:-1])), frame[1:-1], data)
+            buf = bytearray()
+            self.assertEqual(bytes(buf[:msg.dump_into(buf)]), frame, data)
+            for load in (Message.load, Message.load_from):
+                self.assertEqual(load(frame).payload, msg.payload, data)
+
+
+if __name__ == '__main__':
+    unittest.main()